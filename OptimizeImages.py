@@ -1,23 +1,331 @@
 # Quick script to take every image and optimize it to be a single pixel
 # that represents the average color of every pixel. This is meant to be
-# used on far away objects where the details of the texture no longer 
+# used on far away objects where the details of the texture no longer
 # matter, thus allowing us to optimize away all of those details and
 # avearge out all of the colors to a single pixel. This should in theory
 # reduce vRAM usage a bit
 
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
 import bpy
 import numpy as np
 from mathutils import Color
 
+# Estimate the average from a sample of the pixels instead of
+# averaging every one of them, for far away objects where an exact
+# average doesn't matter. "SCALE" downscales a copy of the image
+# with Image.scale (done in C) and averages that, while "SAMPLE"
+# averages randomly picked pixels. Either way, about enough pixels
+# are used for the estimate to be within APPROXIMATE_MAX_ERROR of
+# the exact average with APPROXIMATE_CONFIDENCE, though only "SAMPLE"
+# actually guarantees that. "SAMPLE" still has to read the whole
+# image first, so it saves the averaging but not the read. The copy
+# "SCALE" works on is reloaded from the file, so images that are
+# generated or have unsaved changes get "SAMPLE" instead
+APPROXIMATE = False
+APPROXIMATE_METHOD = 'SCALE'
+APPROXIMATE_MAX_ERROR = 0.01
+APPROXIMATE_CONFIDENCE = 0.99
+
+# Also compute the exact average and print how far off the
+# approximation was, for checking the settings above
+APPROXIMATE_CHECK = False
+
+# Only collapse as many textures as needed for the textures used
+# by the selection to fit in this much VRAM (in MiB), picking the
+# biggest and least visible ones first. None collapses them all
+VRAM_BUDGET = None
+
+# Only print what would be collapsed, without changing anything.
+# Images are sized up from their cache or precomputed entry when
+# they have one, anything else has to be loaded to get its size
+DRY_RUN = False
+
+# Instead of using the selected objects, pick the objects in the
+# scene that are far from (or small to) the active camera. "DISTANCE"
+# picks objects further away than AUTO_SELECT_DISTANCE, while
+# "SCREEN_SIZE" picks objects smaller than AUTO_SELECT_SCREEN_SIZE
+# (as a fraction of the frame width). None uses the selection
+AUTO_SELECT = None
+AUTO_SELECT_DISTANCE = 50.0
+AUTO_SELECT_SCREEN_SIZE = 0.05
+
+# How many frames across the scene's frame range to check. Objects
+# are only picked if they're far away/small on every one of them
+AUTO_SELECT_FRAMES = 1
+
+# Instead of collapsing every texture to a single pixel, shrink it
+# to a resolution picked from how far each object is from the scene
+# camera. LOD_LEVELS maps a distance to the resolution used from
+# there on, where 1 is the single average color pixel. Materials
+# shared by several objects get the biggest resolution any of them
+# needs. Setting LOD_SIZE uses that one resolution for everything
+LOD = False
+LOD_LEVELS = {0.0: 64, 25.0: 16, 50.0: 4, 100.0: 1}
+LOD_SIZE = None
+
+# Swap image texture nodes for RGB nodes holding the average color,
+# instead of pointing them at single pixel images. Shaders skip the
+# texture lookup entirely, and no new images get created. Anything
+# using the alpha output gets a value node set to the average alpha,
+# so cutouts stay see-through. Byte images in a color space other
+# than sRGB or linear still get a single pixel image, since their
+# average can't be turned into a linear color here
+REPLACE_WITH_RGB = False
+
+# Keep computed averages in a cache file, so images that haven't
+# changed since the last run don't even need to be loaded. The
+# cache goes in CACHE_DIR, or next to the blend file if it's None
+USE_CACHE = True
+CACHE_DIR = None
+CACHE_MAX_ENTRIES = 10000
+
+# Empty the cache before running, for when it's gone stale
+CLEAR_CACHE = False
+
+# Bump whenever the way averages are computed or what the cache
+# holds changes, so old cache entries get thrown out
+CACHE_VERSION = 3
+
+# Results file from precompute_image_averages.py, which computes
+# averages (and LOD levels) for lots of images at once in background
+# Blender processes. Images that haven't changed since then are
+# taken from it without being loaded. None computes everything here
+PRECOMPUTED = None
+
+# Has to match the version precompute_image_averages.py writes
+PRECOMPUTED_VERSION = 3
+
+def read_pixels(image):
+    """
+    Reads the pixels of the image as an (N, channels) float32 array.
+    This is one full copy of the image, since bpy has no way to read
+    only part of the pixels (slicing image.pixels still copies all of
+    them first).
+    """
+    # Read straight into a float32 buffer, skipping the tuple
+    # (and float64 copy) that image.pixels[:] would make
+    pixels = np.empty(len(image.pixels), dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    return pixels.reshape((-1, image.channels))
+
+def rgba_mean(mean):
+    """
+    Expands the mean of every channel of an image to RGBA, the same
+    way Blender expands the pixels themselves.
+    """
+    rgb = mean[:3] if len(mean) >= 3 else np.repeat(mean[:1], 3)
+    alpha = mean[3:4] if len(mean) == 4 else [1.0]
+    return np.concatenate((rgb, alpha))
+
 def average_image_color(image):
-    """Averages the colors of the pixels in the image."""
-    pixels = np.array(image.pixels[:])
-    num_pixels = len(pixels) // 4
-    pixels = pixels.reshape((num_pixels, 4))  # (R, G, B, A)
+    """Averages the pixels in the image, as RGBA."""
+    # Summing in float64 keeps the average accurate even
+    # over hundreds of millions of pixels
+    return rgba_mean(read_pixels(image).mean(axis=0, dtype=np.float64))
+
+def image_info(image):
+    """
+    What it takes to size the image up without loading it again, as
+    kept next to the average in the cache and precomputed entries.
+    """
+    return {
+        "size": list(image.size),
+        "channels": image.channels,
+        "is_float": image.is_float,
+    }
+
+class AverageColorCache:
+    """
+    SQLite cache of image average colors, evicting the least recently
+    used entries once it holds more than max_entries. Entries are in
+    the same form as the precomputed ones, a "color" and "alpha" along
+    with the image_info of the image they came from.
+    """
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path)
+
+        # Caches from other versions hold different columns
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != CACHE_VERSION:
+            self.conn.execute("DROP TABLE IF EXISTS colors")
+            self.conn.execute(f"PRAGMA user_version = {CACHE_VERSION}")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS colors "
+            "(key TEXT PRIMARY KEY, r REAL, g REAL, b REAL, a REAL, width INTEGER, "
+            "height INTEGER, channels INTEGER, is_float INTEGER, last_used REAL)"
+        )
+
+    def get(self, key):
+        row = self.conn.execute(
+            "SELECT r, g, b, a, width, height, channels, is_float "
+            "FROM colors WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self.conn.execute(
+            "UPDATE colors SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        return {
+            "color": list(row[:3]),
+            "alpha": row[3],
+            "size": list(row[4:6]),
+            "channels": row[6],
+            "is_float": bool(row[7]),
+        }
+
+    def put(self, key, entry):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO colors VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, *entry["color"], entry["alpha"], *entry["size"], entry["channels"],
+             entry["is_float"], time.time()),
+        )
+
+    def clear(self):
+        self.conn.execute("DELETE FROM colors")
+
+    def close(self):
+        self.conn.execute(
+            "DELETE FROM colors WHERE key NOT IN "
+            "(SELECT key FROM colors ORDER BY last_used DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+        self.conn.commit()
+        self.conn.close()
+
+def cache_path():
+    """Where the cache file lives, based on CACHE_DIR."""
+    directory = CACHE_DIR
+    if directory is None and bpy.data.filepath:
+        directory = bpy.path.abspath("//")
+    elif directory is None:
+        directory = tempfile.gettempdir()
+    return os.path.join(directory, "optimize_images_cache.sqlite")
+
+def image_source_key(image):
+    """
+    Identifies the pixels the image loads, or None if they can't be
+    identified. This only looks at the file on disk (or the packed
+    data), so the image never has to be loaded to check.
+    """
+    if image.is_dirty:
+        return None
+
+    colorspace = image.colorspace_settings.name
+    if image.packed_file is not None:
+        digest = hashlib.blake2b(image.packed_file.data, digest_size=16).hexdigest()
+        return f"packed|{digest}|{colorspace}"
+
+    if image.source != 'FILE':
+        return None
+
+    path = bpy.path.abspath(image.filepath, library=image.library)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    path = os.path.realpath(path)
+    return f"{path}|{stat.st_size}|{stat.st_mtime_ns}|{colorspace}"
 
-    # Average only the RGB channels, ignoring alpha
-    avg_rgb = np.mean(pixels[:, :3], axis=0)
-    return Color(avg_rgb)
+def image_cache_key(image):
+    """Key for the image's average color in the cache, or None if it can't be cached."""
+    key = image_source_key(image)
+    if key is None:
+        return None
+    return f"{CACHE_VERSION}|{averaging_mode()}|{key}"
+
+def load_precomputed(path):
+    """
+    Reads a results file from precompute_image_averages.py, returning
+    its entries keyed by image_source_key.
+    """
+    with open(bpy.path.abspath(path)) as f:
+        results = json.load(f)
+    if results.get("version") != PRECOMPUTED_VERSION:
+        print(f"{path} is from a different version, ignoring it")
+        return {}
+    return results["images"]
+
+def precomputed_levels(entry):
+    """The LOD levels in a precomputed entry, as arrays keyed by size."""
+    levels = {}
+    for size, values in entry.get("levels", {}).items():
+        size = int(size)
+        levels[size] = np.array(values, dtype=np.float32).reshape((size, size, 4))
+    return levels
+
+def approximate_sample_count(max_error, confidence):
+    """
+    How many pixels to sample for their average to be within
+    max_error of the real average with the given confidence, going
+    by Hoeffding's inequality (which assumes values from 0 to 1).
+    """
+    return math.ceil(math.log(2 / (1 - confidence)) / (2 * max_error**2))
+
+def approximate_image_color(image):
+    """Estimates the average of the image as RGBA from a sample of its pixels."""
+    width, height = image.size
+    num_pixels = width * height
+    num_samples = approximate_sample_count(APPROXIMATE_MAX_ERROR,
+                                           APPROXIMATE_CONFIDENCE)
+    if num_pixels <= num_samples:
+        return average_image_color(image)
+
+    # Image.copy reloads the pixels from the file (or regenerates
+    # them), which misses any that only exist in memory
+    method = APPROXIMATE_METHOD
+    if image.is_dirty or image.source != 'FILE':
+        method = 'SAMPLE'
+
+    if method == 'SCALE':
+        # Keep the aspect ratio while getting down to about
+        # num_samples pixels
+        factor = math.sqrt(num_samples / num_pixels)
+        small = image.copy()
+        try:
+            small.scale(max(1, math.ceil(width * factor)),
+                        max(1, math.ceil(height * factor)))
+            return average_image_color(small)
+        finally:
+            bpy.data.images.remove(small)
+
+    # bpy can't read only some of the pixels, so this is the same
+    # full float32 read as the exact average
+    pixels = read_pixels(image)
+
+    # Independent random picks, which is what the sample count
+    # from Hoeffding's inequality assumes
+    indices = np.random.default_rng().integers(num_pixels, size=num_samples)
+    return rgba_mean(pixels[indices].mean(axis=0, dtype=np.float64))
+
+def compute_image_color(image):
+    """Averages the image as RGBA, exactly or approximately depending on the settings."""
+    if not APPROXIMATE:
+        return average_image_color(image)
+
+    color = approximate_image_color(image)
+    if APPROXIMATE_CHECK:
+        exact = average_image_color(image)
+        error = max(abs(a - b) for a, b in zip(color, exact))
+        print(f"{image.name}: approximate average off by {error:.4f} "
+              f"(target {APPROXIMATE_MAX_ERROR})")
+    return color
+
+def averaging_mode():
+    """Identifies how averages are computed, for the cache key."""
+    if not APPROXIMATE:
+        return "exact"
+    return f"{APPROXIMATE_METHOD}-{APPROXIMATE_MAX_ERROR}-{APPROXIMATE_CONFIDENCE}"
 
 def create_single_pixel_image(color):
     """Creates a 1x1 pixel image of the given color."""
@@ -25,20 +333,541 @@ def create_single_pixel_image(color):
     image.pixels[0:4] = [color.r, color.g, color.b, 1.0]  # Set RGBA values (A = 1)
     return image
 
-def replace_images_with_average_color():
-    for obj in bpy.context.selected_objects:
+# Color spaces byte images can be in that are already linear
+LINEAR_COLORSPACES = {'Linear', 'Linear Rec.709'}
+
+def linear_color(image, entry):
+    """
+    The average color in the image's entry in linear space, for RGB
+    nodes, or None if it can't be converted. Byte images hand back
+    their pixels in their own color space, unless they're data, while
+    float ones (including 16 bit PNGs and TIFFs) are already linear.
+    """
+    color = Color(entry["color"])
+    colorspace = image.colorspace_settings
+    # The entry records whether the pixels were read as floats, since
+    # checking is_float on an image that isn't loaded would load it
+    if (colorspace.is_data or entry["is_float"]
+            or colorspace.name in LINEAR_COLORSPACES):
+        return color
+    if colorspace.name != 'sRGB':
+        return None
+
+    srgb = np.array(color)
+    linear = np.where(srgb <= 0.04045, srgb / 12.92, ((srgb + 0.055) / 1.055)**2.4)
+    return Color(linear)
+
+def replace_with_rgb_node(node, color, alpha):
+    """
+    Swaps the image texture node for an RGB node of the color, keeping
+    its links. Alpha links get a value node holding the alpha instead.
+    """
+    ntree = node.id_data
+    rgb_node = ntree.nodes.new('ShaderNodeRGB')
+    rgb_node.parent = node.parent
+    rgb_node.location = node.location
+    rgb_node.label = node.label or node.image.name
+    rgb_node.outputs[0].default_value = (color.r, color.g, color.b, 1.0)
+
+    for link in node.outputs['Color'].links:
+        ntree.links.new(rgb_node.outputs[0], link.to_socket)
+
+    alpha_links = node.outputs['Alpha'].links
+    if alpha_links:
+        alpha_node = ntree.nodes.new('ShaderNodeValue')
+        alpha_node.parent = node.parent
+        alpha_node.location = (node.location.x, node.location.y - 200)
+        alpha_node.label = "Alpha"
+        alpha_node.outputs[0].default_value = alpha
+        for link in alpha_links:
+            ntree.links.new(alpha_node.outputs[0], link.to_socket)
+
+    ntree.nodes.remove(node)
+
+def block_sums(pixels, size):
+    """
+    Sums the (height, width, channels) pixels over a size x size grid
+    of blocks, returning the sums and how many pixels went into each.
+    """
+    height, width = pixels.shape[:2]
+
+    # Images smaller than the grid end up with repeated edges, where
+    # reduceat returns the single pixel at that edge
+    row_edges = np.arange(size) * height // size
+    col_edges = np.arange(size) * width // size
+    sums = np.add.reduceat(pixels, row_edges, axis=0, dtype=np.float64)
+    sums = np.add.reduceat(sums, col_edges, axis=1)
+
+    row_counts = np.maximum(np.diff(row_edges, append=height), 1)
+    col_counts = np.maximum(np.diff(col_edges, append=width), 1)
+    return sums, np.outer(row_counts, col_counts)
+
+def box_filter_levels(image, sizes):
+    """
+    Box filters the image down to every one of the given square sizes,
+    returning (size, size, 4) float32 RGBA arrays keyed by size. The
+    smaller sizes are summed up from the biggest size's blocks rather
+    than the pixels, so they come almost for free while still being
+    exact area averages.
+    """
+    width, height = image.size
+    pixels = read_pixels(image).reshape((height, width, image.channels))
+
+    top = max(sizes)
+    top_sums, top_counts = block_sums(pixels, top)
+
+    levels = {}
+    for size in sizes:
+        if top % size or top > min(width, height):
+            # Doesn't line up with the biggest level's blocks, or
+            # those repeat pixels and would skew the average
+            sums, counts = block_sums(pixels, size)
+        else:
+            factor = top // size
+            sums = top_sums.reshape((size, factor, size, factor, -1)).sum(axis=(1, 3))
+            counts = top_counts.reshape((size, factor, size, factor)).sum(axis=(1, 3))
+
+        level = (sums / counts[..., None]).astype(np.float32)
+        if image.channels < 3:
+            level = np.repeat(level[..., :1], 3, axis=2)
+        if level.shape[2] < 4:
+            alpha = np.ones((size, size, 1), dtype=np.float32)
+            level = np.concatenate((level[..., :3], alpha), axis=2)
+        levels[size] = level
+    return levels
+
+def create_lod_image(image, pixels):
+    """Creates a reduced copy of the image from (size, size, 4) RGBA pixels."""
+    size = pixels.shape[0]
+    lod_image = bpy.data.images.new(f"LOD{size}_{image.name}", width=size,
+                                    height=size, alpha=True,
+                                    float_buffer=image.is_float)
+    lod_image.colorspace_settings.name = image.colorspace_settings.name
+    lod_image.pixels.foreach_set(pixels.ravel())
+    return lod_image
+
+def object_camera_metrics(objects, camera):
+    """
+    Computes the distance from the camera and the screen size (as a
+    fraction of the frame width) of every object in the collection
+    at once, from their world space bounding boxes.
+    """
+    num_objects = len(objects)
+
+    # Matrices come out column major, so transpose them
+    matrices = np.empty(num_objects * 16, dtype=np.float32)
+    objects.foreach_get("matrix_world", matrices)
+    matrices = matrices.reshape((num_objects, 4, 4)).transpose((0, 2, 1))
+
+    corners = np.empty(num_objects * 24, dtype=np.float32)
+    objects.foreach_get("bound_box", corners)
+    corners = corners.reshape((num_objects, 8, 3))
+
+    world_corners = (np.einsum('nij,nkj->nki', matrices[:, :3, :3], corners)
+                     + matrices[:, None, :3, 3])
+    centers = world_corners.mean(axis=1)
+    radii = np.linalg.norm(world_corners - centers[:, None], axis=2).max(axis=1)
+
+    cam_matrix = np.array(camera.matrix_world)
+    cam_location = cam_matrix[:3, 3]
+    cam_forward = -cam_matrix[:3, 2] / np.linalg.norm(cam_matrix[:3, 2])
+
+    offsets = centers - cam_location
+    distances = np.linalg.norm(offsets, axis=1)
+
+    if camera.data.type == 'ORTHO':
+        sizes = 2 * radii / camera.data.ortho_scale
+    else:
+        # Objects behind the camera aren't visible at all
+        depths = offsets @ cam_forward
+        half_width = np.maximum(depths, 1e-6) * math.tan(camera.data.angle / 2)
+        sizes = np.where(depths > 0, radii / half_width, 0.0)
+
+    return distances, sizes
+
+def auto_select_objects(scene):
+    """
+    Picks the mesh objects in the scene that are far away from, or
+    small to, the scene camera across the sampled frames.
+    """
+    camera = scene.camera
+    if camera is None:
+        print("AUTO_SELECT needs a scene camera, no objects picked")
+        return []
+
+    objects = scene.objects
+    is_mesh = np.array([obj.type == 'MESH' for obj in objects], dtype=bool)
+
+    frames = np.unique(np.linspace(scene.frame_start, scene.frame_end,
+                                   AUTO_SELECT_FRAMES).round().astype(int))
+    current_frame = scene.frame_current
+
+    picked = is_mesh
+    for frame in frames:
+        if len(frames) > 1:
+            scene.frame_set(int(frame))
+
+        distances, sizes = object_camera_metrics(objects, camera)
+        if AUTO_SELECT == 'DISTANCE':
+            picked = picked & (distances > AUTO_SELECT_DISTANCE)
+        else:
+            picked = picked & (sizes < AUTO_SELECT_SCREEN_SIZE)
+
+    if len(frames) > 1:
+        scene.frame_set(current_frame)
+
+    picked_objects = [obj for obj, pick in zip(objects, picked) if pick]
+    print(f"Picked {len(picked_objects)} of {int(is_mesh.sum())} mesh objects "
+          f"based on {AUTO_SELECT.lower().replace('_', ' ')}")
+    return picked_objects
+
+def lod_object_sizes(objects, scene):
+    """Picks the LOD resolution for every object, from its distance to the camera."""
+    if LOD_SIZE is not None:
+        return {obj: LOD_SIZE for obj in objects}
+
+    camera = scene.camera
+    if camera is None:
+        print("LOD needs a scene camera, using the biggest level for everything")
+        return {obj: max(LOD_LEVELS.values()) for obj in objects}
+
+    distances, _ = object_camera_metrics(scene.objects, camera)
+    thresholds = sorted(LOD_LEVELS)
+    indices = np.searchsorted(thresholds, distances, side='right') - 1
+
+    wanted = set(objects)
+    return {obj: LOD_LEVELS[thresholds[max(index, 0)]]
+            for obj, index in zip(scene.objects, indices) if obj in wanted}
+
+def plan_lod_tree_sizes(object_sizes):
+    """
+    Picks the LOD resolution for every material and node group tree
+    used by the objects. Shared trees get the biggest resolution any
+    of their objects need, so closer objects never lose detail.
+    """
+    material_sizes = {}
+    for obj, size in object_sizes.items():
+        if obj.type != 'MESH':
+            continue
+        for mat in set(obj.data.materials):
+            if mat is None or not mat.use_nodes:
+                continue
+            material_sizes[mat] = max(material_sizes.get(mat, 0), size)
+
+    tree_sizes = {}
+    for mat, size in material_sizes.items():
+        for ntree in iter_node_trees(mat.node_tree, set()):
+            tree_sizes[ntree] = max(tree_sizes.get(ntree, 0), size)
+    return tree_sizes
+
+def replace_images_with_lods(image_nodes, tree_sizes, precomputed):
+    """
+    Points the image nodes whose tree needs more than a single pixel
+    at box filtered copies of their image. Every size needed from an
+    image is built in one pass, and shared by all the nodes using it.
+    Levels already in the image's precomputed entry are used as is.
+    Returns the nodes left for the single pixel path, entries for any
+    averages found along the way, and how many images were created.
+    """
+    remaining = {}
+    entries = {}
+    created = 0
+    for image, nodes in image_nodes.items():
+        by_size = {}
+        for node in nodes:
+            size = tree_sizes.get(node.id_data, 1)
+            # Not worth replacing an image that's already this small
+            if size > 1 and size >= max(image.size):
+                continue
+            by_size.setdefault(size, []).append(node)
+
+        if not by_size:
+            continue
+        if list(by_size) == [1]:
+            remaining[image] = nodes
+            continue
+
+        names = ", ".join(f"{size}x{size}" for size in sorted(by_size, reverse=True))
+        levels = precomputed_levels(precomputed.get(image, {}))
+        if all(size == 1 or size in levels for size in by_size):
+            print(f"{image.name}: using precomputed {names}")
+        else:
+            start = time.perf_counter()
+            levels = box_filter_levels(image, list(by_size))
+            elapsed = time.perf_counter() - start
+            print(f"{image.name}: built {names} in {elapsed * 1000:.1f}ms")
+
+        for size, size_nodes in by_size.items():
+            if size == 1:
+                remaining[image] = size_nodes
+                if 1 in levels:
+                    entries[image] = {"color": levels[1][0, 0, :3].tolist(),
+                                      "alpha": float(levels[1][0, 0, 3]),
+                                      **image_info(image)}
+                continue
+
+            lod_image = create_lod_image(image, levels[size])
+            created += 1
+            for node in size_nodes:
+                node.image = lod_image
+
+    return remaining, entries, created
+
+def collect_materials(objects):
+    """
+    Collects the unique node based materials used by the objects,
+    along with how many of the objects use each one.
+    """
+    materials = {}
+    for obj in objects:
         if obj.type == 'MESH' and obj.data.materials:
-            for mat in obj.data.materials:
-                if not mat.use_nodes:
+            for mat in set(obj.data.materials):
+                if mat is None or not mat.use_nodes:
                     continue
-                for node in mat.node_tree.nodes:
-                    # Check if node is an image texture node
-                    if not node.type == 'TEX_IMAGE' or not node.image:
-                        continue
-                    image = node.image
-                    avg_color = average_image_color(image)
-                    new_image = create_single_pixel_image(avg_color)
-                    node.image = new_image
-                    new_image.name = f"AvgColor_{image.name}"
-
-replace_images_with_average_color()
+                materials[mat] = materials.get(mat, 0) + 1
+    return materials
+
+def iter_node_trees(ntree, visited):
+    """Yields the node tree and every node group inside it, each only once."""
+    if ntree in visited:
+        return
+    visited.add(ntree)
+    yield ntree
+
+    for node in ntree.nodes:
+        if node.type == 'GROUP' and node.node_tree:
+            yield from iter_node_trees(node.node_tree, visited)
+
+def collect_image_nodes(materials):
+    """
+    Collects every image texture node in the materials (including
+    ones inside node groups), grouped by the image they use.
+    """
+    image_nodes = {}
+    visited = set()
+    for mat in materials:
+        for ntree in iter_node_trees(mat.node_tree, visited):
+            for node in ntree.nodes:
+                # Check if node is an image texture node
+                if not node.type == 'TEX_IMAGE' or not node.image:
+                    continue
+                image_nodes.setdefault(node.image, []).append(node)
+    return image_nodes
+
+def image_visibility(materials):
+    """
+    How many of the objects use each image, as a rough measure of
+    how visible it is.
+    """
+    visibility = {}
+    for mat, num_objects in materials.items():
+        images = set()
+        for ntree in iter_node_trees(mat.node_tree, set()):
+            for node in ntree.nodes:
+                if node.type == 'TEX_IMAGE' and node.image:
+                    images.add(node.image)
+        for image in images:
+            visibility[image] = visibility.get(image, 0) + num_objects
+    return visibility
+
+def known_image_info(image, entry):
+    """
+    The image_info of the image, from its cache or precomputed entry
+    if it isn't loaded, since reading it off the image would load it.
+    None if the image isn't loaded and has no entry.
+    """
+    if image.has_data:
+        return image_info(image)
+    return entry
+
+def estimate_vram_bytes(info, use_half_precision):
+    """Rough estimate of how much GPU memory an image with the image_info takes up."""
+    width, height = info["size"]
+    if info["is_float"]:
+        bytes_per_channel = 2 if use_half_precision else 4
+        bytes_per_pixel = bytes_per_channel * info["channels"]
+    else:
+        # Byte images get uploaded as RGBA
+        bytes_per_pixel = 4
+
+    # Mipmaps add another third on top
+    return width * height * bytes_per_pixel * 4 // 3
+
+def plan_vram_budget(image_nodes, materials, budget, entries):
+    """
+    Picks which images to collapse to fit the rest in the budget (in
+    bytes), or all of them if the budget is None. Images that free the
+    most memory per object using them go first. Prints the plan.
+    """
+    # Only images without an entry get loaded to size them up
+    infos = {image: known_image_info(image, entries.get(image)) or image_info(image)
+             for image in image_nodes}
+    sizes = {image: estimate_vram_bytes(infos[image], image.use_half_precision)
+             for image in image_nodes}
+    visibility = image_visibility(materials)
+    total = sum(sizes.values())
+
+    order = sorted(image_nodes,
+                   key=lambda image: sizes[image] / max(visibility.get(image, 0), 1),
+                   reverse=True)
+
+    chosen = {}
+    remaining = total
+    for image in order:
+        if budget is not None and remaining <= budget:
+            break
+        chosen[image] = image_nodes[image]
+        remaining -= sizes[image]
+
+    for image in chosen:
+        width, height = infos[image]["size"]
+        print(f"Collapse {image.name}: {width}x{height}, "
+              f"{sizes[image] / 2**20:.1f} MiB, "
+              f"used by {visibility.get(image, 0)} objects")
+
+    budget_text = "no budget" if budget is None else f"budget {budget / 2**20:.1f} MiB"
+    print(f"Textures use about {total / 2**20:.1f} MiB of VRAM ({budget_text}). "
+          f"Collapsing {len(chosen)} of {len(image_nodes)} saves "
+          f"{(total - remaining) / 2**20:.1f} MiB, "
+          f"leaving {remaining / 2**20:.1f} MiB")
+    if budget is not None and remaining > budget:
+        print("Warning: collapsing every texture still doesn't fit the budget")
+
+    return chosen
+
+def image_size_bytes(image, entry):
+    """
+    Size of the image's pixel data once loaded. Images that aren't
+    loaded are sized from their cache or precomputed entry instead,
+    since getting their size would load them.
+    """
+    info = known_image_info(image, entry)
+    if info is None:
+        return 0
+
+    width, height = info["size"]
+    bytes_per_channel = 4 if info["is_float"] else 1
+    return width * height * info["channels"] * bytes_per_channel
+
+def replace_images_with_average_color():
+    # Plan everything up front, so shared materials, node groups
+    # and images are only ever handled once
+    if AUTO_SELECT is None:
+        objects = bpy.context.selected_objects
+    else:
+        objects = auto_select_objects(bpy.context.scene)
+
+    materials = collect_materials(objects)
+    image_nodes = collect_image_nodes(materials)
+
+    # Look up everything already known about the images first,
+    # so planning doesn't have to load them either
+    precomputed = {}
+    if PRECOMPUTED is not None:
+        results = load_precomputed(PRECOMPUTED)
+        for image in image_nodes:
+            entry = results.get(image_source_key(image))
+            if entry is not None:
+                precomputed[image] = entry
+        print(f"{len(precomputed)} of {len(image_nodes)} images were precomputed")
+
+    cache = None
+    if USE_CACHE:
+        cache = AverageColorCache(cache_path(), CACHE_MAX_ENTRIES)
+        if CLEAR_CACHE:
+            cache.clear()
+
+    # Averages of the images, along with their image_info
+    entries = dict(precomputed)
+    cache_hits = 0
+    if cache is not None:
+        for image in image_nodes:
+            key = image_cache_key(image) if image not in entries else None
+            entry = cache.get(key) if key is not None else None
+            if entry is not None:
+                entries[image] = entry
+                cache_hits += 1
+        print(f"{cache_hits} of {len(image_nodes)} averages came from the cache")
+
+    budget = VRAM_BUDGET * 2**20 if VRAM_BUDGET is not None else None
+    if budget is not None or DRY_RUN:
+        image_nodes = plan_vram_budget(image_nodes, materials, budget, entries)
+    if DRY_RUN:
+        if cache is not None:
+            cache.close()
+        return
+
+    # Keep hold of every image, since the LOD pass hands back
+    # only the ones still left to collapse to a single pixel
+    images = list(image_nodes)
+
+    lod_images = 0
+    if LOD:
+        tree_sizes = plan_lod_tree_sizes(lod_object_sizes(objects, bpy.context.scene))
+        image_nodes, lod_entries, lod_images = replace_images_with_lods(
+            image_nodes, tree_sizes, precomputed)
+        entries.update(lod_entries)
+
+    # Images that average out to the same color share one
+    # 1x1 image, keyed by that color
+    palette = {}
+    rgb_nodes = 0
+    for image, nodes in image_nodes.items():
+        entry = entries.get(image)
+        if entry is None:
+            tracemalloc.start()
+            start = time.perf_counter()
+            rgba = compute_image_color(image)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{image.name}: averaged in {elapsed * 1000:.1f}ms, "
+                  f"peak memory {peak / 2**20:.1f} MiB")
+
+            entry = {"color": rgba[:3].tolist(), "alpha": float(rgba[3]),
+                     **image_info(image)}
+            key = image_cache_key(image) if cache is not None else None
+            if key is not None:
+                cache.put(key, entry)
+
+        entries[image] = entry
+        avg_color = Color(entry["color"])
+
+        if REPLACE_WITH_RGB:
+            color = linear_color(image, entry)
+            if color is not None:
+                for node in nodes:
+                    replace_with_rgb_node(node, color, entry["alpha"])
+                rgb_nodes += len(nodes)
+                continue
+
+        color_key = tuple(avg_color)
+        new_image = palette.get(color_key)
+        if new_image is None:
+            new_image = create_single_pixel_image(avg_color)
+            new_image.name = f"AvgColor_{image.name}"
+            palette[color_key] = new_image
+
+        for node in nodes:
+            node.image = new_image
+
+    if cache is not None:
+        cache.close()
+
+    # Remove the original images nothing uses anymore
+    removed = 0
+    removed_bytes = 0
+    for image in images:
+        if image.users > 0:
+            continue
+        removed_bytes += image_size_bytes(image, entries.get(image))
+        bpy.data.images.remove(image)
+        removed += 1
+
+    print(f"Replaced {len(images)} images in {len(materials)} materials "
+          f"with {len(palette)} average color images, {rgb_nodes} RGB nodes "
+          f"and {lod_images} LOD images, removed {removed} "
+          f"images ({removed_bytes / 2**20:.1f} MiB of pixel data)")
+
+if __name__ == "__main__":
+    replace_images_with_average_color()
@@ -0,0 +1,301 @@
+# Copyright (C) 2025 Maryam Sheikh (Mahid Sheikh) <mahid@standingpad.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Batch version of unwrap_selected.py for whole asset libraries.
+#
+# Run with regular Python, this is the driver:
+#
+#   python batch_unwrap.py path/to/library other.blend -j 8
+#
+# It finds every .blend file, and runs a `blender -b` worker for
+# each one (N at a time) with this same script. The worker opens
+# the file, cube projects every mesh in it (or just the ones that
+# match --filter), and saves it.
+#
+# Every finished file is appended to a log as it completes, so an
+# interrupted run can be picked back up with --resume without
+# redoing the files that already went through.
+
+import argparse
+import fnmatch
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+try:
+    import bpy
+except ImportError:
+    # Running as the driver outside of Blender
+    bpy = None
+
+# Prefix for the line the worker prints its results on, so
+# the driver can pick it out of Blender's other output
+RESULT_PREFIX = "BATCH_UNWRAP_RESULT "
+
+
+def worker_main(argv: list[str]) -> None:
+    """Unwraps and saves the currently opened blend file"""
+    parser = argparse.ArgumentParser(prog="batch_unwrap.py (worker)")
+    parser.add_argument("--filter", default="*")
+    parser.add_argument("--engine", default="NUMPY")
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args(argv)
+
+    # The addon version has no side effects on import,
+    # unlike the script version
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import unwrap_selected_addon as unwrap
+
+    start = time.perf_counter()
+
+    meshes = [
+        mesh
+        for mesh in bpy.data.meshes
+        # Linked meshes can't be saved back into this file
+        if mesh.library is None and fnmatch.fnmatchcase(mesh.name, args.filter)
+    ]
+    # Whatever face selection a file was saved with has nothing to
+    # do with the batch, so every face gets projected
+    unwrapped = [
+        mesh
+        for mesh in meshes
+        if unwrap.unwrap_mesh(
+            mesh, args.engine, force=args.force, use_select=False
+        )
+    ]
+
+    unwrap_time = time.perf_counter() - start
+
+    # Nothing to save if every mesh was already up to date
+    if unwrapped:
+        bpy.ops.wm.save_mainfile()
+
+    result = {
+        "meshes": len(meshes),
+        "unwrapped": len(unwrapped),
+        "unwrap_time": unwrap_time,
+    }
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+def find_blend_files(paths: list[str]) -> list[Path]:
+    """Expands the given files and directories into a list of blend files"""
+    files = {}
+    for path in map(Path, paths):
+        if path.is_dir():
+            for file in sorted(path.rglob("*.blend")):
+                files[file.resolve()] = None
+        else:
+            files[path.resolve()] = None
+    return list(files)
+
+
+def read_log(log_path: Path) -> dict[str, dict]:
+    """Reads the results of previous runs, keyed by file path"""
+    entries = {}
+    if not log_path.exists():
+        return entries
+
+    with log_path.open() as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Most likely a partially written line from
+                # a run that got killed
+                continue
+            entries[entry["file"]] = entry
+    return entries
+
+
+def run_worker(file: Path, args: argparse.Namespace) -> dict:
+    """Runs a Blender worker on the given file and returns its result"""
+    cmd = [
+        args.blender,
+        "-b",
+        "--factory-startup",
+        "--python-exit-code",
+        "1",
+        str(file),
+        "--python",
+        str(Path(__file__).resolve()),
+        "--",
+        "--filter",
+        args.filter,
+        "--engine",
+        args.engine,
+    ]
+    if args.force:
+        cmd.append("--force")
+
+    start = time.perf_counter()
+    try:
+        proc = subprocess.run(
+            cmd,
+            capture_output=True,
+            text=True,
+            timeout=args.timeout,
+        )
+    except subprocess.TimeoutExpired:
+        return {
+            "file": str(file),
+            "status": "failed",
+            "time": time.perf_counter() - start,
+            "error": f"Timed out after {args.timeout} seconds",
+        }
+    elapsed = time.perf_counter() - start
+
+    result = None
+    for line in proc.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            result = json.loads(line[len(RESULT_PREFIX) :])
+
+    if proc.returncode != 0 or result is None:
+        # Blender can still exit cleanly if it never got to run the
+        # script (e.g. a broken file), so a missing result also fails
+        output = (proc.stderr or proc.stdout).strip().splitlines()
+        return {
+            "file": str(file),
+            "status": "failed",
+            "time": elapsed,
+            "error": "\n".join(output[-20:]),
+        }
+
+    return {
+        "file": str(file),
+        "status": "ok",
+        "time": elapsed,
+        **result,
+    }
+
+
+def driver_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        description="Cube project every mesh in a set of blend files"
+    )
+    parser.add_argument(
+        "paths", nargs="+", help="Blend files, or directories to search for them"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of Blender workers to run at once",
+    )
+    parser.add_argument(
+        "--blender", default="blender", help="Path to the Blender executable"
+    )
+    parser.add_argument(
+        "--filter", default="*", help="Only unwrap meshes whose name matches this"
+    )
+    parser.add_argument("--engine", default="NUMPY", choices=("NUMPY", "BMESH"))
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Unwrap meshes even if they haven't changed since the last unwrap",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=None, help="Seconds to allow per file"
+    )
+    parser.add_argument(
+        "--log",
+        default="batch_unwrap_log.jsonl",
+        help="File to record finished files in, used for --resume",
+    )
+    parser.add_argument(
+        "--report",
+        default="batch_unwrap_report.json",
+        help="File to write the summary report to",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip files the log says were already unwrapped",
+    )
+    args = parser.parse_args(argv)
+
+    log_path = Path(args.log)
+    files = find_blend_files(args.paths)
+
+    previous = read_log(log_path) if args.resume else {}
+    if not args.resume and log_path.exists():
+        log_path.unlink()
+
+    todo = [
+        file
+        for file in files
+        if previous.get(str(file), {}).get("status") != "ok"
+    ]
+    print(f"{len(files) - len(todo)} files already done, {len(todo)} to unwrap")
+
+    results = {
+        str(file): previous[str(file)] for file in files if str(file) in previous
+    }
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+        futures = [pool.submit(run_worker, file, args) for file in todo]
+
+        with log_path.open("a") as log:
+            for i, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                results[result["file"]] = result
+
+                log.write(json.dumps(result) + "\n")
+                log.flush()
+
+                print(
+                    f"[{i}/{len(todo)}] {result['status']:6} "
+                    f"{result['time']:7.2f}s {result['file']}"
+                )
+
+    failed = [r for r in results.values() if r["status"] != "ok"]
+    report = {
+        "files": len(results),
+        "ok": len(results) - len(failed),
+        "failed": len(failed),
+        "meshes": sum(r.get("meshes", 0) for r in results.values()),
+        "wall_time": time.perf_counter() - start,
+        "file_time": sum(r["time"] for r in results.values()),
+        "failures": failed,
+        "results": sorted(results.values(), key=lambda r: r["time"], reverse=True),
+    }
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(
+        f"Unwrapped {report['ok']}/{report['files']} files "
+        f"({report['meshes']} meshes) in {report['wall_time']:.2f}s, "
+        f"{report['failed']} failed. Report written to {args.report}"
+    )
+    for result in failed:
+        print(f"FAILED {result['file']}:\n{result['error']}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    if bpy is not None:
+        worker_main(sys.argv[sys.argv.index("--") + 1 :] if "--" in sys.argv else [])
+    else:
+        sys.exit(driver_main(sys.argv[1:]))
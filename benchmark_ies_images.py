@@ -0,0 +1,382 @@
+# Copyright (C) 2025 Maryam Sheikh (Mahid Sheikh) <mahid@standingpad.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmarks what pack_ies_files.py adds to saving, and how fast
+# OptimizeImages.py gets through textures. Run with:
+#
+#   blender -b --factory-startup --python benchmark_ies_images.py -- --output bench.json
+#
+# The IES benchmark builds a scene with N lights, each with an IES
+# node pointing at one of a set of generated IES files, plus a chain
+# of nested node groups (with more IES nodes) shared by every light.
+# It's saved with the hook off, then with it on (packing everything),
+# then once more with it on and nothing left to pack.
+#
+# The image benchmark builds materials holding M random textures at
+# each resolution, and times OptimizeImages.py averaging all of them.
+# Memory is measured around the averaging only: the peak is reset
+# right before it, and reported as how far it got above the resident
+# memory at that point, leaving out the textures being built. This
+# needs Linux's /proc, elsewhere the memory columns are left empty.
+#
+# Both approximate averaging methods are also checked against the
+# exact average on a saved random texture, failing the run if either
+# is further off than APPROXIMATE_MAX_ERROR.
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import bpy
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import OptimizeImages as optimize  # noqa: E402
+from benchmark_memory import MeasureRSS  # noqa: E402
+import pack_ies_files as pack  # noqa: E402
+
+IES_TEMPLATE = """IESNA:LM-63-2002
+[TEST] benchmark_ies_images.py profile {index}
+TILT=NONE
+1 {lumens} 1 3 1 1 2 0 0 0
+1 1 100
+0 45 90
+0
+{lumens} {half} 0
+"""
+
+
+def reset_scene() -> None:
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+
+
+def write_ies_files(directory: str, count: int) -> list[str]:
+    """Writes count different IES profiles, returning their paths"""
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"profile_{i}.ies")
+        with open(path, "w") as f:
+            f.write(IES_TEMPLATE.format(index=i, lumens=1000 + i, half=500 + i))
+        paths.append(path)
+    return paths
+
+
+def add_ies_node(ntree: bpy.types.NodeTree, path: str) -> bpy.types.Node:
+    node = ntree.nodes.new("ShaderNodeTexIES")
+    node.mode = "EXTERNAL"
+    node.filepath = path
+    return node
+
+
+def build_group_chain(depth: int, ies_paths: list[str]) -> bpy.types.NodeTree | None:
+    """
+    Builds depth node groups nested inside each other, each with an
+    IES node, returning the outermost one
+    """
+    inner = None
+    for level in range(depth):
+        group = bpy.data.node_groups.new(f"ies_group_{level}", "ShaderNodeTree")
+        add_ies_node(group, ies_paths[level % len(ies_paths)])
+        if inner is not None:
+            group_node = group.nodes.new("ShaderNodeGroup")
+            group_node.node_tree = inner
+        inner = group
+    return inner
+
+
+def build_ies_scene(num_lights: int, depth: int, ies_paths: list[str]) -> None:
+    """Adds num_lights lights with IES nodes, all sharing one group chain"""
+    group = build_group_chain(depth, ies_paths)
+    scene = bpy.context.scene
+
+    for i in range(num_lights):
+        light = bpy.data.lights.new(f"light_{i}", "POINT")
+        light.use_nodes = True
+        ntree = light.node_tree
+
+        ies = add_ies_node(ntree, ies_paths[i % len(ies_paths)])
+        emission = next(n for n in ntree.nodes if n.type == "EMISSION")
+        ntree.links.new(ies.outputs["Fac"], emission.inputs["Strength"])
+
+        if group is not None:
+            group_node = ntree.nodes.new("ShaderNodeGroup")
+            group_node.node_tree = group
+
+        obj = bpy.data.objects.new(f"light_{i}", light)
+        scene.collection.objects.link(obj)
+
+
+def count_external_ies() -> int:
+    trees = [light.node_tree for light in bpy.data.lights if light.node_tree]
+    trees += list(bpy.data.node_groups)
+    return sum(
+        1
+        for ntree in trees
+        for node in ntree.nodes
+        if node.bl_idname == "ShaderNodeTexIES" and node.mode == "EXTERNAL"
+    )
+
+
+def timed_save(path: str) -> float:
+    start = time.perf_counter()
+    bpy.ops.wm.save_as_mainfile(filepath=path)
+    return time.perf_counter() - start
+
+
+def benchmark_save(
+    num_lights: int, depth: int, ies_paths: list[str], directory: str
+) -> dict:
+    """Times saving the IES scene with the packing hook off and on"""
+    reset_scene()
+    build_ies_scene(num_lights, depth, ies_paths)
+    external = count_external_ies()
+    path = os.path.join(directory, f"ies_{num_lights}.blend")
+
+    save_off = timed_save(path)
+
+    pack.register()
+    try:
+        # Same state as right after opening a file
+        pack.load(None)
+        save_cold = timed_save(path)
+        save_warm = timed_save(path)
+    finally:
+        pack.unregister()
+
+    return {
+        "lights": num_lights,
+        "group_depth": depth,
+        "ies_files": len(ies_paths),
+        "ies_nodes": external,
+        "left_unpacked": count_external_ies(),
+        "ies_texts": len(bpy.data.texts),
+        "save_off": save_off,
+        "save_on_cold": save_cold,
+        "save_on_warm": save_warm,
+        "hook_overhead_cold": save_cold - save_off,
+        "hook_overhead_warm": save_warm - save_off,
+        "file_size": os.path.getsize(path),
+    }
+
+
+def build_texture_scene(
+    num_textures: int, resolution: int, per_material: int, rng: np.random.Generator
+) -> None:
+    """
+    Adds a selected plane using num_textures random textures at the
+    given resolution, spread over materials with per_material each
+    """
+    mesh = bpy.data.meshes.new("textured")
+    mesh.from_pydata([(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0)], [], [(0, 1, 2, 3)])
+    obj = bpy.data.objects.new("textured", mesh)
+    bpy.context.scene.collection.objects.link(obj)
+
+    material = None
+    for i in range(num_textures):
+        if i % per_material == 0:
+            material = bpy.data.materials.new(f"material_{i // per_material}")
+            material.use_nodes = True
+            mesh.materials.append(material)
+
+        image = bpy.data.images.new(f"texture_{i}", resolution, resolution, alpha=True)
+        pixels = rng.random(resolution * resolution * 4, dtype=np.float32)
+        image.pixels.foreach_set(pixels)
+
+        node = material.node_tree.nodes.new("ShaderNodeTexImage")
+        node.image = image
+
+    for other in bpy.context.view_layer.objects:
+        other.select_set(False)
+    obj.select_set(True)
+    bpy.context.view_layer.objects.active = obj
+
+
+def benchmark_images(
+    num_textures: int, resolution: int, per_material: int, rng: np.random.Generator
+) -> dict:
+    """Times OptimizeImages.py averaging every texture in the scene"""
+    reset_scene()
+    build_texture_scene(num_textures, resolution, per_material, rng)
+
+    with MeasureRSS() as memory:
+        start = time.perf_counter()
+        optimize.replace_images_with_average_color()
+        elapsed = time.perf_counter() - start
+
+    return {
+        "textures": num_textures,
+        "resolution": resolution,
+        "megapixels": num_textures * resolution * resolution / 1e6,
+        "time": elapsed,
+        "images_per_sec": num_textures / elapsed if elapsed > 0 else None,
+        "rss_increase": memory.increase,
+        "peak_rss_increase": memory.peak_increase,
+        "images_left": len(bpy.data.images),
+    }
+
+
+def check_approximate(
+    resolution: int, directory: str, rng: np.random.Generator
+) -> list[dict]:
+    """
+    Checks both approximate averaging methods against the exact
+    average of a random texture. It's saved and loaded back from
+    disk first, otherwise "SCALE" would fall back to sampling.
+    """
+    reset_scene()
+    image = bpy.data.images.new("approximate", resolution, resolution, alpha=True)
+    image.pixels.foreach_set(rng.random(resolution * resolution * 4, dtype=np.float32))
+    path = os.path.join(directory, f"approximate_{resolution}.png")
+    image.filepath_raw = path
+    image.file_format = "PNG"
+    image.save()
+    bpy.data.images.remove(image)
+    image = bpy.data.images.load(path)
+
+    exact = np.array(optimize.average_image_color(image))
+    results = []
+    original_method = optimize.APPROXIMATE_METHOD
+    try:
+        for method in ("SCALE", "SAMPLE"):
+            optimize.APPROXIMATE_METHOD = method
+            start = time.perf_counter()
+            approximate = np.array(optimize.approximate_image_color(image))
+            elapsed = time.perf_counter() - start
+
+            error = float(np.abs(approximate - exact).max())
+            results.append(
+                {
+                    "method": method,
+                    "resolution": resolution,
+                    "time": elapsed,
+                    "error": error,
+                    "max_error": optimize.APPROXIMATE_MAX_ERROR,
+                    "within_bound": error <= optimize.APPROXIMATE_MAX_ERROR,
+                }
+            )
+    finally:
+        optimize.APPROXIMATE_METHOD = original_method
+    return results
+
+
+def main(argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(prog="benchmark_ies_images.py")
+    parser.add_argument(
+        "--lights",
+        default="10,100,1000,5000",
+        help="Comma separated light counts for the save benchmark",
+    )
+    parser.add_argument("--ies-files", type=int, default=20)
+    parser.add_argument("--group-depth", type=int, default=3)
+    parser.add_argument(
+        "--textures",
+        default="10,50",
+        help="Comma separated texture counts for the image benchmark",
+    )
+    parser.add_argument(
+        "--resolutions",
+        default="256,1024,2048",
+        help="Comma separated texture resolutions for the image benchmark",
+    )
+    parser.add_argument("--textures-per-material", type=int, default=4)
+    parser.add_argument(
+        "--approximate-resolutions",
+        default="512,2048",
+        help="Comma separated texture resolutions to check approximate averaging on",
+    )
+    parser.add_argument("--skip-save", action="store_true")
+    parser.add_argument("--skip-images", action="store_true")
+    parser.add_argument("--skip-approximate", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_ies_images.json")
+    args = parser.parse_args(argv)
+
+    # Time the averaging itself, not cache or precomputed lookups
+    optimize.USE_CACHE = False
+    optimize.AUTO_SELECT = None
+    optimize.PRECOMPUTED = None
+    rng = np.random.default_rng(args.seed)
+
+    save_results = []
+    image_results = []
+    approximate_results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        ies_paths = write_ies_files(tmp, args.ies_files)
+
+        if not args.skip_save:
+            for num_lights in (int(n) for n in args.lights.split(",")):
+                stats = benchmark_save(num_lights, args.group_depth, ies_paths, tmp)
+                save_results.append(stats)
+                print(
+                    f"{num_lights:>6} lights: save off {stats['save_off']:.3f}s, "
+                    f"on {stats['save_on_cold']:.3f}s (cold) "
+                    f"{stats['save_on_warm']:.3f}s (warm), "
+                    f"{stats['left_unpacked']} left unpacked"
+                )
+
+        if not args.skip_images:
+            cases = [
+                (int(count), int(res))
+                for count in args.textures.split(",")
+                for res in args.resolutions.split(",")
+            ]
+            for num_textures, resolution in cases:
+                stats = benchmark_images(
+                    num_textures, resolution, args.textures_per_material, rng
+                )
+                image_results.append(stats)
+                print(
+                    f"{num_textures:>5} textures at {resolution:>5}px: "
+                    f"{stats['time']:8.3f}s "
+                    f"{stats['images_per_sec'] or 0:10.1f} images/s "
+                    f"peak RSS +{(stats['peak_rss_increase'] or 0) / 2**20:9.1f} MiB"
+                )
+
+        if not args.skip_approximate:
+            for resolution in (int(n) for n in args.approximate_resolutions.split(",")):
+                for stats in check_approximate(resolution, tmp, rng):
+                    approximate_results.append(stats)
+                    print(
+                        f"{stats['method']:>6} approximation at {resolution:>5}px: "
+                        f"{stats['time']:8.3f}s, off by {stats['error']:.4f} "
+                        f"(max {stats['max_error']})"
+                    )
+
+    report = {
+        "blender_version": bpy.app.version_string,
+        "numpy_version": np.__version__,
+        "seed": args.seed,
+        "save": save_results,
+        "images": image_results,
+        "approximate": approximate_results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    failed = [stats for stats in approximate_results if not stats["within_bound"]]
+    print(
+        f"{len(failed)} approximations out of bounds, "
+        f"results written to {args.output}"
+    )
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[sys.argv.index("--") + 1 :] if "--" in sys.argv else [])
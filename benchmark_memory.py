@@ -0,0 +1,65 @@
+# Copyright (C) 2025 Maryam Sheikh (Mahid Sheikh) <mahid@standingpad.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Memory measurements shared by the benchmarks. They read Linux's
+# /proc, so elsewhere every measurement comes out as None.
+
+
+def read_rss() -> tuple[int, int] | None:
+    """Current and peak resident memory of this process in bytes, if it can be read"""
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        # Reported in KiB
+        return (
+            int(fields["VmRSS"].split()[0]) * 1024,
+            int(fields["VmHWM"].split()[0]) * 1024,
+        )
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def reset_peak_rss() -> bool:
+    """Resets the peak resident memory to the current one, returning if it worked"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class MeasureRSS:
+    """
+    Measures how far the resident memory of this process grows over
+    a with block. Unlike tracemalloc, this also sees what Blender
+    allocates in C. The peak is reset on entering, so earlier work
+    doesn't count towards it.
+    """
+
+    def __enter__(self) -> "MeasureRSS":
+        self.increase = None
+        self.peak_increase = None
+        self.has_peak = reset_peak_rss()
+        self.before = read_rss()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        after = read_rss()
+        if self.before is None or after is None:
+            return
+        self.increase = after[0] - self.before[0]
+        if self.has_peak:
+            self.peak_increase = after[1] - self.before[0]
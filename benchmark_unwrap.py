@@ -0,0 +1,296 @@
+# Copyright (C) 2025 Maryam Sheikh (Mahid Sheikh) <mahid@standingpad.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmarks the cube projection implementations in
+# unwrap_selected_addon.py against Blender's own operator,
+# and checks that they all give the same UVs. Run with:
+#
+#   blender -b --factory-startup --python benchmark_unwrap.py -- --output bench.json
+#
+# Every mesh is made of randomly oriented quads, so every
+# projection plane gets used. The built-in operator uses
+# the bounding box center of the selection when there's no
+# 3D view, so the same center is passed to our engines too.
+#
+# Peak memory is how far the process's resident memory rose over
+# the run, so it covers Blender's own allocations (which the BUILTIN
+# and BMESH engines make in C) as well as Python and NumPy's.
+
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import bpy
+import bmesh
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import unwrap_selected_addon as unwrap  # noqa: E402
+from benchmark_memory import MeasureRSS  # noqa: E402
+
+CUBE_SIZE = 1.0
+
+
+def build_mesh(num_faces: int, rng: np.random.Generator) -> bpy.types.Mesh:
+    """Builds a mesh of randomly placed and oriented quads"""
+    centers = rng.uniform(-1.0, 1.0, (num_faces, 3))
+    normals = rng.normal(size=(num_faces, 3))
+    normals /= np.linalg.norm(normals, axis=1)[:, None]
+
+    # Two tangents for every face to build the quad with
+    helper = np.where(
+        np.abs(normals[:, :1]) < 0.9, [[1.0, 0.0, 0.0]], [[0.0, 1.0, 0.0]]
+    )
+    t1 = np.cross(normals, helper)
+    t1 /= np.linalg.norm(t1, axis=1)[:, None]
+    t2 = np.cross(normals, t1)
+
+    size = 0.01
+    t1 *= size
+    t2 *= size
+    corners = np.stack(
+        (
+            centers - t1 - t2,
+            centers + t1 - t2,
+            centers + t1 + t2,
+            centers - t1 + t2,
+        ),
+        axis=1,
+    )
+
+    num_loops = num_faces * 4
+    mesh = bpy.data.meshes.new(f"bench_{num_faces}")
+    mesh.vertices.add(num_loops)
+    mesh.loops.add(num_loops)
+    mesh.polygons.add(num_faces)
+
+    mesh.vertices.foreach_set("co", corners.astype(np.float32).ravel())
+    mesh.loops.foreach_set("vertex_index", np.arange(num_loops, dtype=np.int32))
+    mesh.polygons.foreach_set(
+        "loop_start", np.arange(0, num_loops, 4, dtype=np.int32)
+    )
+    mesh.update(calc_edges=True)
+
+    mesh.uv_layers.new(do_init=False)
+    return mesh
+
+
+def set_selection(mesh: bpy.types.Mesh, fraction: float, rng) -> None:
+    """Selects the given fraction of faces at random"""
+    select = rng.random(len(mesh.polygons)) < fraction
+    mesh.polygons.foreach_set("select", select)
+    mesh.update()
+
+
+def selection_bounds_center(mesh: bpy.types.Mesh) -> np.ndarray:
+    """
+    Bounding box center of the selected faces, which is what
+    the built-in operator projects around in background mode
+    """
+    num_faces = len(mesh.polygons)
+    select = np.empty(num_faces, dtype=bool)
+    mesh.polygons.foreach_get("select", select)
+
+    loop_totals = np.empty(num_faces, dtype=np.int32)
+    mesh.polygons.foreach_get("loop_total", loop_totals)
+    vert_indices = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", vert_indices)
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+
+    loop_select = np.repeat(select, loop_totals)
+    selected_co = co.reshape((-1, 3))[vert_indices[loop_select]]
+    return (selected_co.min(axis=0) + selected_co.max(axis=0)) / 2.0
+
+
+def read_uvs(mesh: bpy.types.Mesh) -> np.ndarray:
+    uvs = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+    mesh.uv_layers.active.data.foreach_get("uv", uvs)
+    return uvs.reshape((-1, 2))
+
+
+def run_builtin(mesh: bpy.types.Mesh, center) -> None:
+    obj = bpy.data.objects.new(mesh.name, mesh)
+    bpy.context.scene.collection.objects.link(obj)
+
+    # Only this object should end up in edit mode
+    for other in bpy.context.view_layer.objects:
+        other.select_set(False)
+    bpy.context.view_layer.objects.active = obj
+    obj.select_set(True)
+
+    bpy.ops.object.mode_set(mode="EDIT")
+    bpy.ops.uv.cube_project(
+        cube_size=CUBE_SIZE,
+        correct_aspect=False,
+        clip_to_bounds=False,
+        scale_to_bounds=False,
+    )
+    bpy.ops.object.mode_set(mode="OBJECT")
+
+    bpy.data.objects.remove(obj)
+
+
+def run_bmesh(mesh: bpy.types.Mesh, center) -> None:
+    bm = bmesh.new()
+    bm.from_mesh(mesh)
+    unwrap.cube_project(bm, CUBE_SIZE, True, center=center)
+    bm.to_mesh(mesh)
+    bm.free()
+    mesh.update()
+
+
+def run_numpy(mesh: bpy.types.Mesh, center) -> None:
+    unwrap.cube_project_mesh(mesh, CUBE_SIZE, True, center=center, threads=1)
+
+
+def run_numpy_threaded(mesh: bpy.types.Mesh, center) -> None:
+    unwrap.cube_project_mesh(
+        mesh, CUBE_SIZE, True, center=center, threads=os.cpu_count()
+    )
+
+
+# The reference implementation has to come first
+ENGINES = {
+    "BUILTIN": run_builtin,
+    "BMESH": run_bmesh,
+    "NUMPY": run_numpy,
+    "NUMPY_THREADED": run_numpy_threaded,
+}
+
+
+def benchmark_engine(
+    engine: str, base: bpy.types.Mesh, center
+) -> tuple[dict, np.ndarray]:
+    """Runs the engine on a copy of the base mesh and returns its stats and UVs"""
+    mesh = base.copy()
+
+    with MeasureRSS() as memory:
+        start = time.perf_counter()
+        ENGINES[engine](mesh, center)
+        elapsed = time.perf_counter() - start
+
+    uvs = read_uvs(mesh)
+    bpy.data.meshes.remove(mesh)
+
+    num_faces = len(base.polygons)
+    return {
+        "engine": engine,
+        "time": elapsed,
+        "faces_per_sec": num_faces / elapsed if elapsed > 0 else None,
+        "peak_rss_increase": memory.peak_increase,
+    }, uvs
+
+
+def main(argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(prog="benchmark_unwrap.py")
+    parser.add_argument(
+        "--sizes",
+        default="1000,10000,100000,1000000,5000000",
+        help="Comma separated face counts to benchmark",
+    )
+    parser.add_argument(
+        "--engines",
+        default=",".join(ENGINES),
+        help="Comma separated engines to benchmark",
+    )
+    parser.add_argument(
+        "--selection",
+        type=float,
+        default=0.5,
+        help="Fraction of faces selected in the partial selection runs",
+    )
+    parser.add_argument("--tolerance", type=float, default=1e-5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_unwrap.json")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    engines = [engine for engine in ENGINES if engine in args.engines.split(",")]
+    rng = np.random.default_rng(args.seed)
+
+    results = []
+    mismatches = 0
+    for num_faces in sizes:
+        for selection in ("all", "partial"):
+            base = build_mesh(num_faces, rng)
+            set_selection(base, 1.0 if selection == "all" else args.selection, rng)
+            center = selection_bounds_center(base)
+
+            reference = None
+            numpy_uvs = None
+            for engine in engines:
+                stats, uvs = benchmark_engine(engine, base, center)
+
+                # The threaded engine has to give exactly the
+                # same UVs as the single threaded one
+                if engine == "NUMPY":
+                    numpy_uvs = uvs
+                elif engine == "NUMPY_THREADED" and numpy_uvs is not None:
+                    stats["identical_to_numpy"] = bool(np.array_equal(uvs, numpy_uvs))
+                    if not stats["identical_to_numpy"]:
+                        mismatches += 1
+
+                if reference is None:
+                    reference = uvs
+                    stats["reference"] = True
+                else:
+                    error = float(np.abs(uvs - reference).max())
+                    stats["max_error"] = error
+                    stats["matches"] = error <= args.tolerance
+                    if not stats["matches"]:
+                        mismatches += 1
+
+                stats.update(
+                    faces=num_faces,
+                    loops=len(base.loops),
+                    selection=selection,
+                )
+                results.append(stats)
+                print(
+                    f"{num_faces:>9} faces {selection:>7} {engine:>8}: "
+                    f"{stats['time']:8.3f}s "
+                    f"{stats['faces_per_sec'] or 0:14,.0f} faces/s "
+                    f"{(stats['peak_rss_increase'] or 0) / 2**20:9.1f} MiB"
+                    + (
+                        f" max error {stats['max_error']:.2e}"
+                        if "max_error" in stats
+                        else ""
+                    )
+                )
+
+            bpy.data.meshes.remove(base)
+
+    report = {
+        "blender_version": bpy.app.version_string,
+        "numpy_version": np.__version__,
+        "tolerance": args.tolerance,
+        "seed": args.seed,
+        "mismatches": mismatches,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{mismatches} mismatching runs, results written to {args.output}")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[sys.argv.index("--") + 1 :] if "--" in sys.argv else [])
@@ -20,50 +20,291 @@
 # the use of this addon. This whole point of this addon is to 
 # nuke your config.
 
-import bpy
-import os 
+import os
 import shutil
 import atexit
+import ctypes
+import errno
+import subprocess
+import sys
+import threading
+import time
 from pathlib import Path
 
+try:
+	import bpy
+except ImportError:
+	# Running as the separate process that nukes the config
+	# after Blender closes, see delete_config_on_exit
+	bpy = None
+
+try:
+	import fcntl
+except ImportError:
+	# Windows
+	fcntl = None
+
 bl_info = {
 	"name": "Nuke Config",
 	"category": "Object",
 	"location": "3D window toolshelf > Nuke Config",
-	"version": (0, 0, 1),
-	"blender": (2, 80, 0),
+	"version": (0, 1, 0),
+	"blender": (2, 91, 0),
 	"description": "Addon to nuke the Blender config when you accidently forget to import previous settings.",
-	"warning": "Nuked configs are not recoverable.",
+	"warning": "Nuked configs can only be recovered from the snapshots taken before nuking.",
 	"author": "Mahid Sheikh <mahid@standingpad.org>",
 }
 
 CONFIG_FOLDER = Path(os.path.dirname(__file__)).parents[1]
 
+# Where this add-on lives in the config, so restoring a snapshot
+# can leave it out instead of bringing back something that nukes
+# the config again on the next close
+ADDON_PATH = Path(__file__).relative_to(CONFIG_FOLDER)
+
+# The config gets snapshotted here before it's nuked, so
+# it can still be restored if nuking it was a mistake
+SNAPSHOT_FOLDER = CONFIG_FOLDER.parent / "nuke_config_snapshots"
+
+# How many snapshots to keep, the oldest ones get deleted first
+KEEP_SNAPSHOTS = 3
+
+# Linux ioctl that makes a file share another file's data, on
+# filesystems that support it (Btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+def reflink_file(src, dst):
+	"""Copy a file as a reflink, which shares the original's data
+	until one of them changes, so it's instant no matter the size."""
+	if sys.platform == 'darwin':
+		libc = ctypes.CDLL(None, use_errno=True)
+		if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err), dst)
+	elif fcntl is not None:
+		with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+			fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+		shutil.copystat(src, dst)
+	else:
+		raise OSError(errno.EOPNOTSUPP, "Reflinks aren't supported here", dst)
+
+def copy_tree(src, dst, methods, skip=()):
+	"""Copy a folder, using the first of the methods that works.
+
+	Once a method fails it's dropped for the rest of the files, so
+	a filesystem without reflinks only gets asked once. Paths in skip
+	(relative to src) aren't copied. Returns the name of the method
+	that ended up being used."""
+	methods = list(methods)
+	skip = {os.path.normpath(path) for path in skip}
+	for root, dirs, files in os.walk(src):
+		target = os.path.join(dst, os.path.relpath(root, src))
+		os.makedirs(target, exist_ok=True)
+
+		# Keep symlinks as symlinks instead of copying what they point to
+		for name in [d for d in dirs if os.path.islink(os.path.join(root, d))] + files:
+			src_path = os.path.join(root, name)
+			dst_path = os.path.join(target, name)
+			if os.path.relpath(src_path, src) in skip:
+				continue
+			# Make way for the new file. Symlinks have to be checked
+			# first, isdir would follow one to a folder and keep it
+			if os.path.islink(dst_path) or os.path.isfile(dst_path):
+				os.remove(dst_path)
+			elif os.path.isdir(dst_path) and os.path.islink(src_path):
+				shutil.rmtree(dst_path)
+
+			if os.path.islink(src_path):
+				os.symlink(os.readlink(src_path), dst_path)
+				if name in dirs:
+					dirs.remove(name)
+				continue
+
+			while True:
+				try:
+					methods[0](src_path, dst_path)
+					break
+				except OSError:
+					if len(methods) == 1:
+						raise
+					if os.path.lexists(dst_path):
+						os.remove(dst_path)
+					methods.pop(0)
+	return methods[0].__name__
+
+def list_snapshots():
+	"""Snapshots of this config, newest first"""
+	if not SNAPSHOT_FOLDER.is_dir():
+		return []
+	return sorted(SNAPSHOT_FOLDER.glob(f"{CONFIG_FOLDER.name}-*"), reverse=True)
+
+def snapshot_config():
+	"""Snapshot the config folder, with reflinks if possible, then
+	hardlinks (fine, since the originals are about to be deleted),
+	and a plain copy if all else fails"""
+	name = f"{CONFIG_FOLDER.name}-{time.strftime('%Y%m%d-%H%M%S')}"
+	snapshot = SNAPSHOT_FOLDER / name
+	suffix = 1
+	while snapshot.exists():
+		snapshot = SNAPSHOT_FOLDER / f"{name}-{suffix}"
+		suffix += 1
+
+	start = time.perf_counter()
+	method = copy_tree(CONFIG_FOLDER, snapshot, (reflink_file, os.link, shutil.copy2))
+	print(f"Snapshotted {CONFIG_FOLDER} to {snapshot} ({method}) "
+		  f"in {time.perf_counter() - start:.2f}s")
+	return snapshot
+
 def delete_config():
-	shutil.rmtree(CONFIG_FOLDER)
-_ = atexit.register(delete_config)
+	"""Snapshot the config and delete it, along with any snapshots
+	past KEEP_SNAPSHOTS."""
+	if not CONFIG_FOLDER.exists():
+		return
+
+	snapshot_config()
+	for path in [CONFIG_FOLDER] + list_snapshots()[KEEP_SNAPSHOTS:]:
+		shutil.rmtree(path)
+
+def wait_for_exit(pid, timeout=60):
+	"""Wait for the process to exit, so the snapshot doesn't miss
+	anything Blender still writes on its way out"""
+	if sys.platform == 'win32':
+		# SYNCHRONIZE access is all waiting needs
+		kernel32 = ctypes.windll.kernel32
+		handle = kernel32.OpenProcess(0x00100000, False, pid)
+		if handle:
+			kernel32.WaitForSingleObject(handle, int(timeout * 1000))
+			kernel32.CloseHandle(handle)
+		return
+
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		try:
+			os.kill(pid, 0)
+		except OSError:
+			return
+		time.sleep(0.1)
+
+if bpy is None and __name__ == "__main__":
+	# This is the separate process started by delete_config_on_exit
+	wait_for_exit(int(sys.argv[1]))
+	delete_config()
+	sys.exit()
+
+def delete_config_on_exit():
+	"""Leave the snapshot and delete to a separate process running
+	this file, so Blender can finish closing without waiting on it"""
+	subprocess.Popen(
+		[sys.executable, os.path.abspath(__file__), str(os.getpid())],
+		stdin=subprocess.DEVNULL,
+		stdout=subprocess.DEVNULL,
+		stderr=subprocess.DEVNULL,
+		start_new_session=True,
+		creationflags=getattr(subprocess, "DETACHED_PROCESS", 0),
+	)
+_ = atexit.register(delete_config_on_exit)
+
+# Background thread the nuke operator runs on, so
+# the UI doesn't freeze while the config gets copied
+nuke_thread = None
+nuke_error = None
+
+def run_nuke():
+	global nuke_error
+	try:
+		delete_config()
+	except Exception as e:
+		nuke_error = e
+
+def check_nuke():
+	"""Timer that reports back once the nuke thread is done"""
+	if nuke_thread.is_alive():
+		return 0.5
+	if nuke_error is not None:
+		print(f"Failed to nuke {CONFIG_FOLDER}: {nuke_error}")
+	else:
+		print(f"Nuked {CONFIG_FOLDER}")
+	return None
+
+# Blender needs the enum item strings kept alive
+snapshot_items = []
+
+def get_snapshot_items(self, context):
+	snapshot_items[:] = [(path.name, path.name, str(path)) for path in list_snapshots()]
+	if not snapshot_items:
+		snapshot_items.append(('NONE', "No snapshots", ""))
+	return snapshot_items
 
 class NUKE_CONFIG_PT_nuke(bpy.types.Panel):
 	bl_label = "Nuke Config"
 	bl_space_type = 'VIEW_3D'
-	bl_region_type = 'UI'	
+	bl_region_type = 'UI'
 	bl_category = "Nuke Config"
 
 	def draw(self, context):
 		layout = self.layout
 		row = layout.row()
 		row.operator("nuke_config.nuke")
+		row = layout.row()
+		row.operator("nuke_config.restore")
 
 class NUKE_CONFIG_OT_nuke(bpy.types.Operator):
 	bl_idname = "nuke_config.nuke"
 	bl_label = "Nuke Blender Config"
-	bl_description = "Nuke your Blender config :D"
+	bl_description = "Nuke your Blender config :D (a snapshot gets taken first)"
 
 	def execute(self, ctx):
-		delete_config()
+		global nuke_thread, nuke_error
+		if nuke_thread is not None and nuke_thread.is_alive():
+			self.report({'WARNING'}, "Already nuking the config")
+			return {'CANCELLED'}
+
+		nuke_error = None
+		nuke_thread = threading.Thread(target=run_nuke, name="nuke_config")
+		nuke_thread.start()
+		bpy.app.timers.register(check_nuke, first_interval=0.5)
+		self.report({'INFO'}, f"Snapshotting and nuking {CONFIG_FOLDER} in the background")
+		return {'FINISHED'}
+
+class NUKE_CONFIG_OT_restore(bpy.types.Operator):
+	bl_idname = "nuke_config.restore"
+	bl_label = "Restore Blender Config"
+	bl_description = "Restore a snapshot of the config without this add-on, so it won't be nuked when Blender closes"
+
+	snapshot: bpy.props.EnumProperty(name="Snapshot", items=get_snapshot_items)
+
+	def invoke(self, ctx, event):
+		return ctx.window_manager.invoke_props_dialog(self)
+
+	def execute(self, ctx):
+		if nuke_thread is not None and nuke_thread.is_alive():
+			self.report({'ERROR'}, "Wait for the config to finish nuking first")
+			return {'CANCELLED'}
+
+		snapshot = SNAPSHOT_FOLDER / self.snapshot
+		if self.snapshot == 'NONE' or not snapshot.is_dir():
+			self.report({'ERROR'}, "No snapshot to restore")
+			return {'CANCELLED'}
+
+		atexit.unregister(delete_config_on_exit)
+
+		# No hardlinks here, the restored config can't share
+		# its files with the snapshot since it'll be changed.
+		# This add-on is left out, and taken out of the current
+		# config too, so the restored config doesn't nuke itself
+		# again next time Blender closes
+		method = copy_tree(snapshot, CONFIG_FOLDER, (reflink_file, shutil.copy2),
+						   skip=(ADDON_PATH,))
+		addon_file = CONFIG_FOLDER / ADDON_PATH
+		if addon_file.exists():
+			addon_file.unlink()
+
+		self.report({'INFO'}, f"Restored {snapshot.name} ({method}) without this add-on, "
+							  "the config won't be nuked on close")
 		return {'FINISHED'}
 
 classes = (NUKE_CONFIG_OT_nuke,
+		   NUKE_CONFIG_OT_restore,
 		   NUKE_CONFIG_PT_nuke)
 def register():
 	for cls in classes:
@@ -73,4 +314,4 @@ def unregister():
 	for cls in reversed(classes):
 		bpy.utils.unregister_class(cls)
 
-print(f"WILL NUKE CONFIG, COPY {CONFIG_FOLDER} TO A SAFE LOCATION BEFORE CLOSING BLENDER")
+print(f"WILL NUKE CONFIG ON CLOSE, A SNAPSHOT WILL BE KEPT IN {SNAPSHOT_FOLDER}")
@@ -13,63 +13,242 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterator
+import hashlib
+import time
 import bpy
+from bpy.app.handlers import persistent
 
 bl_info = {
     "name" : "Pack IES Files",
     "author" : "Mahid Sheikh <mahid@stanidngpad.org>",
-    "version" : (1, 0),
+    "version" : (1, 3),
     "blender" : (4, 3, 0),
     "description" : "Doing what Blender should have done a long time ago and pack IES files with blend files",
     "warning" : "Will pack IES files for all files when saving, please disable if you don't want this",
     "category" : "Fixing Blender",    
 }
 
-def pack_ies(node: bpy.types.ShaderNodeTexIES) -> None:
-    """Given an IES node with an external file, open the path
-    as a text datablock and set the IES node to the datablock.
+# Print every IES file as it gets packed, on top of the summary
+VERBOSE = False
+
+# Read IES files on this many threads when there's more than one
+# to read. 1 reads them one after another
+READ_THREADS = 8
+
+# Custom property on packed text datablocks with the hash of the
+# file they came from, so identical files share one datablock
+HASH_KEY = "ies_hash"
+
+# The bpy.data collections whose node trees can have IES nodes in them
+NODE_TREE_OWNERS = ("lights", "materials", "worlds", "node_groups")
+
+# (collection, name) of every datablock added or changed since the
+# last save. Only these get looked at when saving, instead of
+# everything in the file
+pending_ids = set()
+
+# Set when everything needs another look, like after loading a file
+rescan_needed = True
+
+def read_ies(path: str) -> tuple[str, str]:
+    """Read an IES file, returning its text and a hash of its contents"""
+    data = Path(path).read_bytes()
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        # Older profiles are often Latin-1
+        text = data.decode("latin-1")
+    return text, digest
+
+def read_ies_files(paths: list[str]) -> dict[str, tuple[str, str] | OSError]:
+    """Read all the IES files at once, on a few threads if there are lots of them"""
+    def read(path):
+        try:
+            return read_ies(path)
+        except OSError as e:
+            return e
+
+    if READ_THREADS > 1 and len(paths) > 1:
+        with ThreadPoolExecutor(max_workers=min(READ_THREADS, len(paths))) as pool:
+            return dict(zip(paths, pool.map(read, paths)))
+    return {path: read(path) for path in paths}
+
+def pack_ies(nodes: list[bpy.types.ShaderNodeTexIES]) -> tuple[int, int, int]:
+    """Given IES nodes with external files, open the paths
+    as text datablocks and set the IES nodes to the datablocks.
 
     Text datablocks are packed with files, unlike external IES
     files. Why this is the case, I don't know, and I'm still
     salty about it, hence why I wrote this script.
+
+    Datablocks are matched by the contents of the file, not its
+    name, so two different spot.ies files don't get mixed up and
+    the same profile used from different places is only packed once.
+    Returns how many nodes were packed, how many datablocks were
+    created, and how many files couldn't be read.
     """
+    nodes_by_path = {}
+    for node in nodes:
+        path = bpy.path.abspath(node.filepath)
+        nodes_by_path.setdefault(path, []).append(node)
+
+    contents = read_ies_files(list(nodes_by_path))
+    texts = {text[HASH_KEY]: text for text in bpy.data.texts if HASH_KEY in text}
+
+    packed = 0
+    created = 0
+    failed = 0
+    for path, path_nodes in nodes_by_path.items():
+        content = contents[path]
+        if isinstance(content, OSError):
+            print(f"Couldn't pack {path}: {content}")
+            failed += 1
+            continue
+
+        text_data, digest = content
+        text = texts.get(digest)
+        if text is None:
+            text = bpy.data.texts.new(Path(path).name)
+            text.write(text_data)
+            text[HASH_KEY] = digest
+            texts[digest] = text
+            created += 1
+
+        for node in path_nodes:
+            if VERBOSE:
+                print(f"Packing {node.filepath} in {node.id_data.name} as {text.name}")
+            node.mode = 'INTERNAL'
+            node.ies = text
+            packed += 1
+
+    return packed, created, failed
 
-    if node.mode == 'EXTERNAL':
-        filepath = Path(bpy.path.abspath(node.filepath))
-        if filepath.name not in bpy.data.texts:
-            bpy.ops.text.open(filepath=bpy.path.abspath(node.filepath))
-        node.mode = 'INTERNAL'
-        node.ies = bpy.data.texts[filepath.name]
+def iter_ies_nodes(
+    ntree: bpy.types.NodeTree, visited: set
+) -> Iterator[bpy.types.ShaderNodeTexIES]:
+    """Iterate through all IES nodes, including ones in group nodes.
+
+    Trees in visited are skipped, and every tree walked gets added
+    to it, so a node group shared by lots of lights and materials
+    only gets walked once when the same set is passed for all of them.
+    """
+    if ntree in visited or ntree.library is not None:
+        return
+    visited.add(ntree)
 
-def iterate_nodes(ntree: bpy.types.NodeTree) -> None:
-    """Iterate through all nodes, including nodes in group nodes"""
     for node in ntree.nodes:
-        print(node.bl_idname)
         if node.type == 'GROUP':
-            group_tree = node.node_tree
-            if not group_tree:
-                continue
-            for group_node in group_tree.nodes:
-                iterate_nodes(group_node)
+            if node.node_tree:
+                yield from iter_ies_nodes(node.node_tree, visited)
         elif node.bl_idname == 'ShaderNodeTexIES':
-            print("IES")
-            pack_ies(node)
-            
+            yield node
+
+def owner_node_tree(id: bpy.types.ID) -> bpy.types.NodeTree | None:
+    """The shader node tree of a light, material, world or node group"""
+    if isinstance(id, bpy.types.NodeTree):
+        return id if id.bl_idname == 'ShaderNodeTree' else None
+    if not id.use_nodes:
+        return None
+    return id.node_tree
+
+def owner_collection(id: bpy.types.ID) -> str | None:
+    """Which of NODE_TREE_OWNERS the ID is in, if any"""
+    if isinstance(id, bpy.types.Object):
+        return "lights" if id.type == 'LIGHT' else None
+    if isinstance(id, bpy.types.Light):
+        return "lights"
+    if isinstance(id, bpy.types.Material):
+        return "materials"
+    if isinstance(id, bpy.types.World):
+        return "worlds"
+    if isinstance(id, bpy.types.NodeTree) and not id.is_embedded_data:
+        return "node_groups"
+    return None
+
+def index_all() -> None:
+    """Mark everything that can have IES nodes as needing a look on the next save"""
+    for collection in NODE_TREE_OWNERS:
+        for id in getattr(bpy.data, collection):
+            pending_ids.add((collection, id.name))
+
+@persistent
+def load(_):
+    global rescan_needed
+    pending_ids.clear()
+    rescan_needed = True
+
+@persistent
+def track_changes(scene, depsgraph):
+    """Keep track of what was added or changed since the last save.
+
+    Edits inside a light, material or world's own node tree come with
+    an update for the light, material or world itself, so that's what
+    gets tracked rather than the tree.
+    """
+    for update in depsgraph.updates:
+        id = update.id.original
+        collection = owner_collection(id)
+        if collection is not None:
+            if isinstance(id, bpy.types.Object):
+                id = id.data
+            pending_ids.add((collection, id.name))
+
+@persistent
 def main(scene):
-    print("Packing IES lights")
-    scene = bpy.context.scene
-    scene_lights = [ob.data for ob in scene.objects if ob.type == 'LIGHT']
+    global rescan_needed
+    start = time.perf_counter()
 
-    for light in scene_lights:
-        if not light.use_nodes:
+    if rescan_needed:
+        index_all()
+        rescan_needed = False
+
+    # Shared between every tree, so each node group
+    # only gets walked once no matter how often it's used
+    visited = set()
+    checked = 0
+    external = {}
+    for collection, name in pending_ids:
+        id = getattr(bpy.data, collection).get(name)
+        if id is None or id.library is not None:
+            continue
+        ntree = owner_node_tree(id)
+        if ntree is None:
             continue
-        iterate_nodes(light.node_tree)
-        
-    print("Done packing IES lights")
+        checked += 1
+        nodes = [
+            node for node in iter_ies_nodes(ntree, visited) if node.mode == 'EXTERNAL'
+        ]
+        if nodes:
+            external[(collection, name)] = nodes
+    pending_ids.clear()
+
+    nodes = [node for owner_nodes in external.values() for node in owner_nodes]
+    packed, created, failed = pack_ies(nodes) if nodes else (0, 0, 0)
+
+    # Nodes whose file couldn't be read are still external, so
+    # their owners get another go on the next save
+    for owner, owner_nodes in external.items():
+        if any(node.mode == 'EXTERNAL' for node in owner_nodes):
+            pending_ids.add(owner)
+
+    elapsed = time.perf_counter() - start
+    print(f"Packed {packed} IES nodes into {created} new text datablocks "
+          f"from {checked} changed datablocks ({len(visited)} node trees), "
+          f"{failed} files failed, in {elapsed * 1000:.1f}ms")
 
 def register():
+    bpy.app.handlers.load_post.append(load)
+    bpy.app.handlers.depsgraph_update_post.append(track_changes)
     bpy.app.handlers.save_pre.append(main)
 
+def unregister():
+    bpy.app.handlers.save_pre.remove(main)
+    bpy.app.handlers.depsgraph_update_post.remove(track_changes)
+    bpy.app.handlers.load_post.remove(load)
+
 if __name__ == "__main__":
     register()
@@ -0,0 +1,350 @@
+# Copyright (C) 2025 Maryam Sheikh (Mahid Sheikh) <mahid@standingpad.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Computes the average colors (and optionally LOD levels) that
+# OptimizeImages.py needs ahead of time, in background Blender
+# processes. Run with regular Python:
+#
+#   python precompute_image_averages.py scene.blend textures/ -j 8 --levels 64,16,4
+#
+# Blend files are opened to find the image files they use, and
+# directories are searched for image files. The images are then split
+# up between N `blender -b` workers, which load them and run the same
+# NumPy code as OptimizeImages.py on them.
+#
+# Set PRECOMPUTED in OptimizeImages.py to the results file, and any
+# image that hasn't changed since is taken from it instead of being
+# loaded. Packed images aren't precomputed, since they'd need their
+# blend file opened to get at them.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+try:
+    import bpy
+except ImportError:
+    # Running as the driver outside of Blender
+    bpy = None
+
+# Prefix for the line the worker prints its results on, so
+# the driver can pick it out of Blender's other output
+RESULT_PREFIX = "PRECOMPUTE_RESULT "
+
+# Has to match PRECOMPUTED_VERSION in OptimizeImages.py
+RESULTS_VERSION = 3
+
+IMAGE_EXTENSIONS = {
+    ".bmp",
+    ".exr",
+    ".hdr",
+    ".jpeg",
+    ".jpg",
+    ".png",
+    ".tga",
+    ".tif",
+    ".tiff",
+    ".webp",
+}
+
+
+def list_worker_main() -> None:
+    """Prints the image files used by the currently opened blend file"""
+    images = []
+    for image in bpy.data.images:
+        if image.source != "FILE" or image.packed_file is not None:
+            continue
+        path = bpy.path.abspath(image.filepath, library=image.library)
+        if not os.path.isfile(path):
+            continue
+        images.append(
+            {
+                "path": os.path.realpath(path),
+                "colorspace": image.colorspace_settings.name,
+            }
+        )
+    print(RESULT_PREFIX + json.dumps({"images": images}), flush=True)
+
+
+def compute_worker_main(batch_path: str, output_path: str, levels: list[int]) -> None:
+    """Averages every image listed in the batch file, writing the results out"""
+    # The guard at the bottom of OptimizeImages.py keeps
+    # it from running on the current file when imported
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import OptimizeImages as optimize
+
+    with open(batch_path) as f:
+        jobs = json.load(f)
+
+    results = {}
+    failed = []
+    start = time.perf_counter()
+    for job in jobs:
+        try:
+            image = bpy.data.images.load(job["path"], check_existing=False)
+        except RuntimeError as e:
+            failed.append({"path": job["path"], "error": str(e)})
+            continue
+
+        try:
+            if job["colorspace"] is not None:
+                image.colorspace_settings.name = job["colorspace"]
+
+            key = optimize.image_source_key(image)
+            if key is None:
+                raise RuntimeError("Couldn't identify the image file")
+
+            # Levels as big as the image itself are never used. The 1x1
+            # level is the average color, so asking for it along with
+            # the others means the pixels only get read once
+            sizes = [size for size in levels if 1 < size < max(image.size)]
+            image_levels = optimize.box_filter_levels(image, [1, *sizes])
+
+            rgba = image_levels[1][0, 0]
+            entry = {
+                "name": image.name,
+                "color": rgba[:3].tolist(),
+                "alpha": float(rgba[3]),
+                **optimize.image_info(image),
+            }
+            if sizes:
+                entry["levels"] = {
+                    str(size): image_levels[size].ravel().round(6).tolist()
+                    for size in sizes
+                }
+            results[key] = entry
+        except Exception as e:
+            failed.append({"path": job["path"], "error": str(e)})
+        finally:
+            # Free the pixels before loading the next one
+            bpy.data.images.remove(image)
+
+    with open(output_path, "w") as f:
+        json.dump(results, f)
+
+    summary = {
+        "images": len(results),
+        "failed": failed,
+        "time": time.perf_counter() - start,
+    }
+    print(RESULT_PREFIX + json.dumps(summary), flush=True)
+
+
+def worker_main(argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(prog="precompute_image_averages.py (worker)")
+    parser.add_argument("--list", action="store_true")
+    parser.add_argument("--batch")
+    parser.add_argument("--output")
+    parser.add_argument("--levels", default="")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        list_worker_main()
+    else:
+        compute_worker_main(args.batch, args.output, parse_levels(args.levels))
+
+
+def parse_levels(text: str) -> list[int]:
+    return [int(size) for size in text.split(",") if size.strip()]
+
+
+def run_blender(
+    args: argparse.Namespace, blend_file: Path | None, worker_args: list[str]
+) -> dict:
+    """
+    Runs this script in a background Blender, returning the worker's
+    result, or raising RuntimeError with the end of its output
+    """
+    cmd = [args.blender, "-b", "--factory-startup", "--python-exit-code", "1"]
+    if blend_file is not None:
+        cmd.append(str(blend_file))
+    cmd += ["--python", str(Path(__file__).resolve()), "--", *worker_args]
+
+    try:
+        proc = subprocess.run(
+            cmd, capture_output=True, text=True, timeout=args.timeout
+        )
+    except subprocess.TimeoutExpired:
+        raise RuntimeError(f"Timed out after {args.timeout} seconds")
+
+    result = None
+    for line in proc.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            result = json.loads(line[len(RESULT_PREFIX) :])
+
+    if proc.returncode != 0 or result is None:
+        output = (proc.stderr or proc.stdout).strip().splitlines()
+        raise RuntimeError("\n".join(output[-20:]))
+    return result
+
+
+def find_images(
+    paths: list[str], args: argparse.Namespace
+) -> tuple[list[dict], list[dict]]:
+    """
+    Expands the given blend files and directories into a list of
+    unique image jobs, along with any blend files that failed to list
+    """
+    blend_files = []
+    jobs = {}
+    for path in map(Path, paths):
+        if path.suffix == ".blend":
+            blend_files.append(path.resolve())
+        elif path.is_dir():
+            for file in sorted(path.rglob("*")):
+                if file.suffix.lower() in IMAGE_EXTENSIONS:
+                    jobs[(str(file.resolve()), args.colorspace)] = None
+        else:
+            jobs[(str(path.resolve()), args.colorspace)] = None
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+        futures = {
+            pool.submit(run_blender, args, file, ["--list"]): file
+            for file in blend_files
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except RuntimeError as e:
+                failed.append({"path": str(futures[future]), "error": str(e)})
+                continue
+            for image in result["images"]:
+                jobs[(image["path"], image["colorspace"])] = None
+
+    return [
+        {"path": path, "colorspace": colorspace} for path, colorspace in jobs
+    ], failed
+
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        description="Precompute image averages and LOD levels for OptimizeImages.py"
+    )
+    parser.add_argument(
+        "paths",
+        nargs="+",
+        help="Blend files to take the images from, or image files and directories",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of Blender workers to run at once",
+    )
+    parser.add_argument(
+        "--blender", default="blender", help="Path to the Blender executable"
+    )
+    parser.add_argument(
+        "--levels",
+        default="",
+        help="Comma separated LOD sizes to compute along with the averages",
+    )
+    parser.add_argument(
+        "--colorspace",
+        default=None,
+        help="Color space for images found in directories (Blender's default if unset)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=16,
+        help="Number of images each Blender worker handles",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=None, help="Seconds to allow per worker"
+    )
+    parser.add_argument(
+        "--output",
+        default="image_averages.json",
+        help="Results file to write, for PRECOMPUTED in OptimizeImages.py",
+    )
+    args = parser.parse_args(argv)
+
+    levels = parse_levels(args.levels)
+    start = time.perf_counter()
+
+    jobs, failed = find_images(args.paths, args)
+    batches = [
+        jobs[i : i + args.batch_size]
+        for i in range(0, len(jobs), max(args.batch_size, 1))
+    ]
+    print(f"Averaging {len(jobs)} images in {len(batches)} batches")
+
+    images = {}
+    with tempfile.TemporaryDirectory() as tmp:
+
+        def run_batch(index: int, batch: list[dict]) -> dict:
+            batch_path = os.path.join(tmp, f"batch_{index}.json")
+            output_path = os.path.join(tmp, f"results_{index}.json")
+            with open(batch_path, "w") as f:
+                json.dump(batch, f)
+
+            worker_args = ["--batch", batch_path, "--output", output_path]
+            worker_args += ["--levels", ",".join(map(str, levels))]
+            result = run_blender(args, None, worker_args)
+            with open(output_path) as f:
+                result["results"] = json.load(f)
+            return result
+
+        with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+            futures = {
+                pool.submit(run_batch, i, batch): batch
+                for i, batch in enumerate(batches)
+            }
+            for i, future in enumerate(as_completed(futures), 1):
+                batch = futures[future]
+                try:
+                    result = future.result()
+                except RuntimeError as e:
+                    failed += [
+                        {"path": job["path"], "error": str(e)} for job in batch
+                    ]
+                    print(f"[{i}/{len(batches)}] failed")
+                    continue
+
+                images.update(result["results"])
+                failed += result["failed"]
+                print(
+                    f"[{i}/{len(batches)}] {result['images']} images "
+                    f"in {result['time']:.2f}s"
+                )
+
+    results = {"version": RESULTS_VERSION, "levels": levels, "images": images}
+    with open(args.output, "w") as f:
+        json.dump(results, f)
+
+    print(
+        f"Precomputed {len(images)} images in {time.perf_counter() - start:.2f}s, "
+        f"{len(failed)} failed. Results written to {args.output}"
+    )
+    for failure in failed:
+        print(f"FAILED {failure['path']}:\n{failure['error']}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    if bpy is not None:
+        worker_main(sys.argv[sys.argv.index("--") + 1 :] if "--" in sys.argv else [])
+    else:
+        sys.exit(main(sys.argv[1:]))
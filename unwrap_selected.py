@@ -13,12 +13,45 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import csv
+import hashlib
+import json
+import os
+import time
+from collections import deque
+from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
 import bpy
 import bmesh
 import mathutils
+import numpy as np
 
 SELECTED = (obj for obj in bpy.context.selected_objects)
 
+# "NUMPY" or "BMESH", see unwrap_mesh
+ENGINE = "NUMPY"
+
+# Unwrap meshes even if they haven't changed since the last unwrap
+FORCE = False
+
+# How many threads to project large meshes with, None picks
+# automatically based on mesh size
+THREADS = None
+
+# What to center the projection on, see CENTER_SPACES. CENTER is
+# the point used when CENTER_SPACE is "OBJECT" (in each mesh's
+# object space) or "WORLD" (in world space)
+CENTER_SPACE = "SELECTION"
+CENTER = (0.0, 0.0, 0.0)
+
+# Time every phase of the unwrap and print the slowest meshes,
+# optionally writing the profile to a .json or .csv file
+PROFILE = False
+PROFILE_TOP = 5
+PROFILE_PATH = ""
+
 
 # The cube projection code is a translation of
 # Blender's C++ code to Python, done by Gemini
@@ -116,72 +149,657 @@ def cube_project(
             loop_uv.uv = (u, v)
 
 
-def unwrap_instance_collection() -> None:
-    bpy.ops.object.select_all(action="SELECT")
-    selected_instance = (obj for obj in bpy.context.selected_objects)
-    bpy.ops.object.select_all(action="DESELECT")
+class UnwrapProfile:
+    """
+    Records how long each phase of unwrapping took for every mesh,
+    for finding out which part of an unwrap is slow.
+    """
+
+    def __init__(self) -> None:
+        self.meshes: dict[str, dict] = {}
+        self.plan_time = 0.0
+
+    @contextmanager
+    def phase(self, mesh: bpy.types.Mesh, name: str):
+        record = self.meshes.get(mesh.name)
+        if record is None:
+            record = {
+                "mesh": mesh.name,
+                "faces": len(mesh.polygons),
+                "loops": len(mesh.loops),
+                "phases": {},
+            }
+            self.meshes[mesh.name] = record
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            phases = record["phases"]
+            phases[name] = phases.get(name, 0.0) + elapsed
+
+    def records(self) -> list[dict]:
+        """Per mesh records with totals, slowest first"""
+        records = []
+        for record in self.meshes.values():
+            total = sum(record["phases"].values())
+            records.append(
+                {
+                    **record,
+                    "total": total,
+                    "faces_per_sec": record["faces"] / total if total > 0 else None,
+                }
+            )
+        records.sort(key=lambda record: record["total"], reverse=True)
+        return records
+
+    def summary(self, top: int = 5) -> list[str]:
+        """One line per mesh for the slowest top meshes"""
+        lines = []
+        for record in self.records()[:top]:
+            slowest = max(record["phases"], key=record["phases"].get)
+            lines.append(
+                f"{record['mesh']}: {record['total'] * 1000:.1f}ms, "
+                f"{record['faces']} faces, "
+                f"{record['faces_per_sec'] or 0:,.0f} faces/s, "
+                f"slowest phase {slowest} "
+                f"({record['phases'][slowest] * 1000:.1f}ms)"
+            )
+        return lines
+
+    def write(self, path: str) -> None:
+        """Writes the profile as CSV if the path ends in .csv, otherwise JSON"""
+        records = self.records()
+        if path.lower().endswith(".csv"):
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(("mesh", "faces", "loops", "phase", "seconds"))
+                writer.writerow(("", "", "", "plan", self.plan_time))
+                for record in records:
+                    for phase, seconds in record["phases"].items():
+                        writer.writerow(
+                            (
+                                record["mesh"],
+                                record["faces"],
+                                record["loops"],
+                                phase,
+                                seconds,
+                            )
+                        )
+            return
+
+        with open(path, "w") as f:
+            json.dump(
+                {"time": time.time(), "plan_time": self.plan_time, "meshes": records},
+                f,
+                indent=2,
+            )
+
+
+def profile_phase(profile: UnwrapProfile | None, mesh: bpy.types.Mesh, name: str):
+    """Times the phase if profiling, otherwise does nothing"""
+    if profile is None:
+        return nullcontext()
+    return profile.phase(mesh, name)
+
+
+def exhaust(steps: Generator):
+    """Runs a generator to completion, returning its return value"""
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
+
+
+# Vectorized version of the above, working directly on
+# Mesh data through foreach_get/foreach_set instead of
+# going through BMesh. On large meshes the per-face and
+# per-loop Python overhead of cube_project dominates, so
+# this does everything in bulk with NumPy instead.
+def get_dominant_axis_indices_array(
+    normals: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Array version of get_dominant_axis_indices, taking an (N, 3)
+    array of face normals. Ties are broken the same way.
+    """
+    abs_n = np.abs(normals)
+    abs_x = abs_n[:, 0]
+    abs_y = abs_n[:, 1]
+    abs_z = abs_n[:, 2]
 
-    for obj in selected_instance:
-        if obj.type != "MESH":
-            continue
+    x_over_y = abs_x > abs_y
+    x_dominant = x_over_y & (abs_x > abs_z)
+    y_dominant = ~x_over_y & (abs_y > abs_z)
 
-        bm = bmesh.new()
-        bm.from_mesh(obj.data)
-        has_selection = any(f.select for f in bm.faces)
+    cox = np.where(x_dominant, 1, 0)
+    coy = np.where(x_dominant | y_dominant, 2, 1)
+    return cox, coy
 
-        cube_project(bm, 1.0, has_selection, center=None)
 
-        bm.to_mesh(obj.data)
-        bm.free()
-        obj.data.update()
+def read_face_selection(mesh: bpy.types.Mesh) -> np.ndarray:
+    """Returns the selection state of every face in the mesh."""
+    select = np.empty(len(mesh.polygons), dtype=bool)
+    mesh.polygons.foreach_get("select", select)
+    return select
 
 
-def main() -> None:
-    for obj in SELECTED:
+def calculate_selection_center_mesh(
+    mesh: bpy.types.Mesh, face_mask: np.ndarray | None = None
+) -> np.ndarray:
+    """
+    Bulk version of calculate_selection_center, averaging the face
+    centers Blender already keeps on the mesh. face_mask picks which
+    faces to average, or all of them if it's None.
+    """
+    num_faces = len(mesh.polygons)
+    centers = np.empty(num_faces * 3, dtype=np.float32)
+    mesh.polygons.foreach_get("center", centers)
+    centers = centers.reshape((num_faces, 3))
+
+    if face_mask is not None:
+        centers = centers[face_mask]
+
+    if len(centers) == 0:
+        return np.zeros(3)
+
+    return centers.mean(axis=0, dtype=np.float64)
+
+
+def project_loops(
+    loop_co: np.ndarray,
+    cox: np.ndarray,
+    coy: np.ndarray,
+    loop_mask: np.ndarray,
+    loc: np.ndarray,
+    scale_inv: float,
+    uvs: np.ndarray,
+) -> None:
+    """
+    Projects the masked loops in a range of loops into uvs, given
+    the projection axes of each loop's face. Only in-place ufuncs
+    are used, which release the GIL, so ranges can be projected
+    from several threads at once.
+    """
+    u = np.empty(len(loop_co))
+    v = np.empty(len(loop_co))
+
+    use_y = cox == 1
+    np.subtract(loop_co[:, 1], loc[1], out=u, where=use_y)
+    np.subtract(loop_co[:, 0], loc[0], out=u, where=~use_y)
+
+    use_z = coy == 2
+    np.subtract(loop_co[:, 2], loc[2], out=v, where=use_z)
+    np.subtract(loop_co[:, 1], loc[1], out=v, where=~use_z)
+
+    # Project coordinate to 0-1 UV space
+    # 0.5 centers the projection on the UV tile
+    for out, axis in ((u, 0), (v, 1)):
+        np.multiply(out, scale_inv, out=out)
+        np.add(out, 0.5, out=out)
+        np.copyto(uvs[:, axis], out, casting="same_kind", where=loop_mask)
+
+
+# Meshes with fewer loops than this aren't worth
+# spinning up threads for
+THREADING_MIN_LOOPS = 1_000_000
+
+
+def project_loops_threaded(
+    loop_co: np.ndarray,
+    cox: np.ndarray,
+    coy: np.ndarray,
+    loop_mask: np.ndarray,
+    loc: np.ndarray,
+    scale_inv: float,
+    uvs: np.ndarray,
+    pool: ThreadPoolExecutor | None = None,
+    threads: int = 1,
+) -> None:
+    """
+    Splits the loops into one contiguous range per thread and
+    projects them with project_loops on the pool. Gives bit-identical
+    results to a single project_loops call. Without a pool, the loops
+    are projected on the calling thread.
+    """
+    num_loops = len(loop_co)
+    threads = max(1, min(threads, num_loops))
+
+    if pool is None or threads == 1:
+        project_loops(loop_co, cox, coy, loop_mask, loc, scale_inv, uvs)
+        return
+
+    bounds = np.linspace(0, num_loops, threads + 1, dtype=np.int64)
+    futures = [
+        pool.submit(
+            project_loops,
+            loop_co[start:end],
+            cox[start:end],
+            coy[start:end],
+            loop_mask[start:end],
+            loc,
+            scale_inv,
+            uvs[start:end],
+        )
+        for start, end in zip(bounds[:-1], bounds[1:])
+    ]
+    for future in futures:
+        future.result()
+
+
+def resolve_threads(num_loops: int, threads: int | None = None) -> int:
+    """
+    How many threads to project a mesh with. If threads is None,
+    it's picked based on the number of loops in the whole mesh.
+    """
+    if threads is not None:
+        return max(1, threads)
+    if num_loops >= THREADING_MIN_LOOPS:
+        return os.cpu_count() or 1
+    return 1
+
+
+def cube_project_mesh_steps(
+    mesh: bpy.types.Mesh,
+    cube_size: float = 1.0,
+    use_select: bool | None = True,
+    center: mathutils.Vector | None = None,
+    chunk_size: int | None = None,
+    threads: int | None = None,
+    profile: UnwrapProfile | None = None,
+) -> Generator[int, None, None]:
+    """
+    Generator version of cube_project_mesh that projects chunk_size
+    faces at a time, yielding how many faces are done after each
+    chunk. UVs are only written to the mesh once every chunk is done,
+    so stopping early leaves the mesh untouched.
+
+    If use_select is None, only the selected faces are projected
+    if there are any, and every face otherwise.
+    """
+    num_faces = len(mesh.polygons)
+    num_loops = len(mesh.loops)
+    if num_faces == 0:
+        return
+
+    with profile_phase(profile, mesh, "read"):
+        normals = np.empty(num_faces * 3, dtype=np.float32)
+        mesh.polygons.foreach_get("normal", normals)
+        normals = normals.reshape((num_faces, 3))
+
+        loop_starts = np.empty(num_faces, dtype=np.int32)
+        loop_totals = np.empty(num_faces, dtype=np.int32)
+        mesh.polygons.foreach_get("loop_start", loop_starts)
+        mesh.polygons.foreach_get("loop_total", loop_totals)
+
+        vert_indices = np.empty(num_loops, dtype=np.int32)
+        mesh.loops.foreach_get("vertex_index", vert_indices)
+
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", co)
+        loop_co = co.reshape((-1, 3))[vert_indices].astype(np.float64)
+
+        face_mask = read_face_selection(mesh)
+        if use_select is None:
+            use_select = bool(face_mask.any())
+        if not use_select:
+            face_mask[:] = True
+
+    with profile_phase(profile, mesh, "center"):
+        if center is None:
+            loc = calculate_selection_center_mesh(mesh, face_mask)
+        else:
+            loc = np.array(center, dtype=np.float64)
+
+    # Prevent division by zero
+    if cube_size == 0.0:
+        cube_size = 1.0
+
+    scale_inv = 1.0 / cube_size
+
+    with profile_phase(profile, mesh, "axes"):
+        # Faces are stored contiguously, so the owning face
+        # of every loop is just the face index repeated
+        loop_face = np.repeat(np.arange(num_faces), loop_totals)
+        loop_mask = face_mask[loop_face]
+
+        # Determine which plane to map each face onto
+        cox, coy = get_dominant_axis_indices_array(normals)
+        loop_cox = cox[loop_face]
+        loop_coy = coy[loop_face]
+
+    with profile_phase(profile, mesh, "read"):
+        # Unselected faces keep their UVs, so read them back
+        # first unless every face is being projected
+        uv_layer = mesh.uv_layers.active
+        uvs = np.zeros(num_loops * 2, dtype=np.float32)
+        if uv_layer is not None and not loop_mask.all():
+            uv_layer.data.foreach_get("uv", uvs)
+        uvs = uvs.reshape((num_loops, 2))
+
+    if chunk_size is None:
+        chunk_size = num_faces
+
+    # Decided once for the whole mesh, so splitting it into chunks
+    # doesn't turn threading off, and every chunk shares one pool
+    threads = resolve_threads(num_loops, threads)
+    pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+
+    with pool or nullcontext():
+        for face_start in range(0, num_faces, chunk_size):
+            face_end = min(face_start + chunk_size, num_faces)
+            chunk = slice(
+                loop_starts[face_start],
+                loop_starts[face_end - 1] + loop_totals[face_end - 1],
+            )
+            with profile_phase(profile, mesh, "project"):
+                project_loops_threaded(
+                    loop_co[chunk],
+                    loop_cox[chunk],
+                    loop_coy[chunk],
+                    loop_mask[chunk],
+                    loc,
+                    scale_inv,
+                    uvs[chunk],
+                    pool,
+                    threads,
+                )
+            yield face_end
+
+    with profile_phase(profile, mesh, "write"):
+        if uv_layer is None:
+            uv_layer = mesh.uv_layers.new(do_init=False)
+
+        uv_layer.data.foreach_set("uv", uvs.ravel())
+        mesh.update()
+
+
+def cube_project_mesh(
+    mesh: bpy.types.Mesh,
+    cube_size: float = 1.0,
+    use_select: bool = True,
+    center: mathutils.Vector | None = None,
+    threads: int | None = None,
+) -> None:
+    """
+    NumPy equivalent of cube_project, operating on Mesh data
+    directly. Gives the same UVs as cube_project (up to float
+    rounding) without a BMesh round trip. Large meshes are
+    projected on several threads, see project_loops_threaded.
+    """
+    exhaust(
+        cube_project_mesh_steps(
+            mesh, cube_size, use_select, center, threads=threads
+        )
+    )
+
+
+# Custom property on the mesh holding the fingerprint of
+# the geometry it was last unwrapped with
+FINGERPRINT_KEY = "unwrap_selected_fingerprint"
+
+
+def mesh_fingerprint(
+    mesh: bpy.types.Mesh,
+    cube_size: float = 1.0,
+    center: mathutils.Vector | None = None,
+    use_select: bool | None = None,
+) -> str:
+    """
+    Computes a compact hash of everything that affects the result
+    of unwrapping the mesh: vertex positions, loop topology, face
+    selection (unless every face gets projected regardless) and the
+    projection settings.
+    """
+    num_faces = len(mesh.polygons)
+
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+
+    loop_totals = np.empty(num_faces, dtype=np.int32)
+    mesh.polygons.foreach_get("loop_total", loop_totals)
+
+    vert_indices = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", vert_indices)
+
+    select = np.empty(num_faces, dtype=bool)
+    mesh.polygons.foreach_get("select", select)
+
+    settings = (
+        len(co),
+        len(loop_totals),
+        len(vert_indices),
+        cube_size,
+        tuple(center) if center is not None else None,
+        use_select,
+    )
+
+    fingerprint = hashlib.blake2b(repr(settings).encode(), digest_size=16)
+    fingerprint.update(co)
+    fingerprint.update(loop_totals)
+    fingerprint.update(vert_indices)
+    if use_select is not False:
+        fingerprint.update(select)
+    return fingerprint.hexdigest()
+
+
+def unwrap_mesh_steps(
+    mesh: bpy.types.Mesh,
+    engine: str = "NUMPY",
+    cube_size: float = 1.0,
+    force: bool = False,
+    chunk_size: int | None = None,
+    threads: int | None = None,
+    profile: UnwrapProfile | None = None,
+    center: mathutils.Vector | None = None,
+    use_select: bool | None = None,
+) -> Generator[int, None, bool]:
+    """
+    Generator version of unwrap_mesh, yielding how many faces are
+    done as it goes (only the NumPy engine works in chunks). Returns
+    whether the mesh was unwrapped.
+    """
+    with profile_phase(profile, mesh, "fingerprint"):
+        fingerprint = mesh_fingerprint(mesh, cube_size, center, use_select)
+        if (
+            not force
+            and mesh.uv_layers.active is not None
+            and mesh.get(FINGERPRINT_KEY) == fingerprint
+        ):
+            return False
+
+    if engine == "NUMPY":
+        yield from cube_project_mesh_steps(
+            mesh,
+            cube_size,
+            use_select,
+            center=center,
+            chunk_size=chunk_size,
+            threads=threads,
+            profile=profile,
+        )
+    else:
+        with profile_phase(profile, mesh, "from_mesh"):
+            bm = bmesh.new()
+            bm.from_mesh(mesh)
+
+        with profile_phase(profile, mesh, "selection"):
+            select = read_face_selection(mesh)
+            if use_select is None:
+                has_selection = bool(select.any())
+            else:
+                has_selection = use_select
+
+        if center is None:
+            with profile_phase(profile, mesh, "center"):
+                center = calculate_selection_center_mesh(
+                    mesh, select if has_selection else None
+                )
+
+        with profile_phase(profile, mesh, "project"):
+            cube_project(bm, cube_size, has_selection, center=center)
+
+        with profile_phase(profile, mesh, "to_mesh"):
+            bm.to_mesh(mesh)
+            bm.free()
+            mesh.update()
+
+    mesh[FINGERPRINT_KEY] = fingerprint
+    return True
+
+
+def unwrap_mesh(
+    mesh: bpy.types.Mesh,
+    engine: str = "NUMPY",
+    cube_size: float = 1.0,
+    force: bool = False,
+    threads: int | None = None,
+    profile: UnwrapProfile | None = None,
+    center: mathutils.Vector | None = None,
+    use_select: bool | None = None,
+) -> bool:
+    """
+    Cube projects the given mesh with the given engine. Meshes that
+    haven't changed since they were last unwrapped are skipped unless
+    force is set. Returns whether the mesh was unwrapped.
+
+    The projection is centered on center (in the mesh's object space)
+    if given, otherwise on the center of the projected faces. With
+    use_select None, only the selected faces are projected if there
+    are any, otherwise it says whether to stick to the selection.
+    """
+    return exhaust(
+        unwrap_mesh_steps(
+            mesh,
+            engine,
+            cube_size,
+            force,
+            threads=threads,
+            profile=profile,
+            center=center,
+            use_select=use_select,
+        )
+    )
+
+
+def plan_unwrap(
+    objects: list[bpy.types.Object],
+) -> tuple[dict[bpy.types.Mesh, mathutils.Matrix], int]:
+    """
+    Gathers the unique meshes behind the given objects so each one is
+    only unwrapped once, no matter how many linked duplicates or
+    instances refer to it. Instance collections are walked directly
+    (including nested ones), so no scenes, selection or operators are
+    touched.
+
+    Returns the world matrix of the first object found using each
+    mesh, and how many datablocks were skipped as duplicates.
+    """
+    meshes = {}
+    visited = set()
+    skipped = 0
+
+    pending = deque((obj, mathutils.Matrix.Identity(4)) for obj in objects)
+    while pending:
+        obj, instance_matrix = pending.popleft()
+        matrix = instance_matrix @ obj.matrix_world
+
         # Get the "instance collection"
         coll = obj.instance_collection
 
-        if not coll:
-            if obj.type != "MESH":
+        if coll:
+            # Collections can end up instancing themselves, so keep
+            # track of which ones we've already walked
+            if coll in visited:
+                skipped += 1
                 continue
 
-            bm = bmesh.new()
-            bm.from_mesh(obj.data)
-            has_selection = any(f.select for f in bm.faces)
-
-            cube_project(bm, 1.0, has_selection, center=None)
+            visited.add(coll)
+            coll_matrix = matrix @ mathutils.Matrix.Translation(-coll.instance_offset)
+            pending.extend((child, coll_matrix) for child in coll.all_objects)
+            continue
 
-            bm.to_mesh(obj.data)
-            bm.free()
-            obj.data.update()
+        if obj.type != "MESH":
+            continue
 
+        if obj.data in meshes:
+            skipped += 1
             continue
 
-        # Copied from here:
-        # https://github.com/SuperFLEB/BlenderEditCollectionAddon/blob/7468e21cf887cb89b92eb0b46a75165ca51b750e/src/__init__.py#L37C9-L42C49
-        #
-        # In essence, what we're doing here is we're
-        # creating a new Blender scene that contains
-        # just the source collection for the object
-        #
-        # From there, we can then perform the rest
-        # of our tasks
-        scene_name = f"temp:{coll.name}"
-        bpy.ops.scene.new(type="EMPTY")
-        new_scene = bpy.context.scene
-        new_scene.name = scene_name
-        bpy.context.window.scene = new_scene
-        new_scene.collection.children.link(coll)
-        bpy.context.view_layer.active_layer_collection = (
-            bpy.context.view_layer.layer_collection.children[coll.name]
-        )
+        meshes[obj.data] = matrix
+
+    return meshes, skipped
+
+
+CENTER_SPACES = (
+    ("SELECTION", "Selection", "Center on the selected faces of each mesh"),
+    ("OBJECT", "Object", "Center on a fixed point in each mesh's object space"),
+    ("WORLD", "World", "Center on a fixed point in world space"),
+    ("CURSOR", "3D Cursor", "Center on the 3D cursor"),
+)
 
-        bpy.ops.object.select_all(action="DESELECT")
-        unwrap_instance_collection()
 
-        # Delete the new scene created for modifying
-        # instance collection
-        bpy.ops.scene.delete()
+def resolve_center(
+    center_space: str,
+    matrix: mathutils.Matrix,
+    center: mathutils.Vector | None = None,
+) -> mathutils.Vector | None:
+    """
+    Returns the projection center in the object space of a mesh with
+    the given world matrix, or None to use the selection center. The
+    given center is in object space for "OBJECT" and in world space
+    for "WORLD". Sharing a world space center means it only needs
+    computing once, rather than once per mesh.
+    """
+    if center_space == "SELECTION":
+        return None
+
+    if center_space == "OBJECT":
+        return mathutils.Vector(center)
+
+    if center_space == "CURSOR":
+        center = bpy.context.scene.cursor.location
+
+    return matrix.inverted_safe() @ mathutils.Vector(center)
+
+
+def main() -> None:
+    profile = UnwrapProfile() if PROFILE else None
+
+    start = time.perf_counter()
+    meshes, skipped = plan_unwrap(list(SELECTED))
+    if profile is not None:
+        profile.plan_time = time.perf_counter() - start
+
+    unchanged = 0
+    for mesh, matrix in meshes.items():
+        center = resolve_center(CENTER_SPACE, matrix, CENTER)
+        if not unwrap_mesh(
+            mesh,
+            ENGINE,
+            force=FORCE,
+            threads=THREADS,
+            profile=profile,
+            center=center,
+        ):
+            unchanged += 1
+
+    print(
+        f"Unwrapped {len(meshes) - unchanged} meshes, "
+        f"skipped {unchanged} unchanged meshes and "
+        f"{skipped} duplicate datablocks"
+    )
+
+    if profile is None:
+        return
+
+    for line in profile.summary(PROFILE_TOP):
+        print(line)
+
+    if PROFILE_PATH:
+        profile.write(bpy.path.abspath(PROFILE_PATH))
 
 
 if __name__ == "__main__":
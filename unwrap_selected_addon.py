@@ -13,9 +13,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import csv
+import hashlib
+import json
+import os
+import time
+from collections import deque
+from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
 import bpy
 import bmesh
 import mathutils
+import numpy as np
 
 bl_info = {
     "name": "Unwrap Selected",
@@ -125,79 +136,881 @@ def cube_project(
             loop_uv.uv = (u, v)
 
 
+class UnwrapProfile:
+    """
+    Records how long each phase of unwrapping took for every mesh,
+    for finding out which part of an unwrap is slow.
+    """
+
+    def __init__(self) -> None:
+        self.meshes: dict[str, dict] = {}
+        self.plan_time = 0.0
+
+    @contextmanager
+    def phase(self, mesh: bpy.types.Mesh, name: str):
+        record = self.meshes.get(mesh.name)
+        if record is None:
+            record = {
+                "mesh": mesh.name,
+                "faces": len(mesh.polygons),
+                "loops": len(mesh.loops),
+                "phases": {},
+            }
+            self.meshes[mesh.name] = record
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            phases = record["phases"]
+            phases[name] = phases.get(name, 0.0) + elapsed
+
+    def records(self) -> list[dict]:
+        """Per mesh records with totals, slowest first"""
+        records = []
+        for record in self.meshes.values():
+            total = sum(record["phases"].values())
+            records.append(
+                {
+                    **record,
+                    "total": total,
+                    "faces_per_sec": record["faces"] / total if total > 0 else None,
+                }
+            )
+        records.sort(key=lambda record: record["total"], reverse=True)
+        return records
+
+    def summary(self, top: int = 5) -> list[str]:
+        """One line per mesh for the slowest top meshes"""
+        lines = []
+        for record in self.records()[:top]:
+            slowest = max(record["phases"], key=record["phases"].get)
+            lines.append(
+                f"{record['mesh']}: {record['total'] * 1000:.1f}ms, "
+                f"{record['faces']} faces, "
+                f"{record['faces_per_sec'] or 0:,.0f} faces/s, "
+                f"slowest phase {slowest} "
+                f"({record['phases'][slowest] * 1000:.1f}ms)"
+            )
+        return lines
+
+    def write(self, path: str) -> None:
+        """Writes the profile as CSV if the path ends in .csv, otherwise JSON"""
+        records = self.records()
+        if path.lower().endswith(".csv"):
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(("mesh", "faces", "loops", "phase", "seconds"))
+                writer.writerow(("", "", "", "plan", self.plan_time))
+                for record in records:
+                    for phase, seconds in record["phases"].items():
+                        writer.writerow(
+                            (
+                                record["mesh"],
+                                record["faces"],
+                                record["loops"],
+                                phase,
+                                seconds,
+                            )
+                        )
+            return
+
+        with open(path, "w") as f:
+            json.dump(
+                {"time": time.time(), "plan_time": self.plan_time, "meshes": records},
+                f,
+                indent=2,
+            )
+
+
+def profile_phase(profile: UnwrapProfile | None, mesh: bpy.types.Mesh, name: str):
+    """Times the phase if profiling, otherwise does nothing"""
+    if profile is None:
+        return nullcontext()
+    return profile.phase(mesh, name)
+
+
+def exhaust(steps: Generator):
+    """Runs a generator to completion, returning its return value"""
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
+
+
+# Vectorized version of the above, working directly on
+# Mesh data through foreach_get/foreach_set instead of
+# going through BMesh. On large meshes the per-face and
+# per-loop Python overhead of cube_project dominates, so
+# this does everything in bulk with NumPy instead.
+def get_dominant_axis_indices_array(
+    normals: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Array version of get_dominant_axis_indices, taking an (N, 3)
+    array of face normals. Ties are broken the same way.
+    """
+    abs_n = np.abs(normals)
+    abs_x = abs_n[:, 0]
+    abs_y = abs_n[:, 1]
+    abs_z = abs_n[:, 2]
+
+    x_over_y = abs_x > abs_y
+    x_dominant = x_over_y & (abs_x > abs_z)
+    y_dominant = ~x_over_y & (abs_y > abs_z)
+
+    cox = np.where(x_dominant, 1, 0)
+    coy = np.where(x_dominant | y_dominant, 2, 1)
+    return cox, coy
+
+
+def read_face_selection(mesh: bpy.types.Mesh) -> np.ndarray:
+    """Returns the selection state of every face in the mesh."""
+    select = np.empty(len(mesh.polygons), dtype=bool)
+    mesh.polygons.foreach_get("select", select)
+    return select
+
+
+def calculate_selection_center_mesh(
+    mesh: bpy.types.Mesh, face_mask: np.ndarray | None = None
+) -> np.ndarray:
+    """
+    Bulk version of calculate_selection_center, averaging the face
+    centers Blender already keeps on the mesh. face_mask picks which
+    faces to average, or all of them if it's None.
+    """
+    num_faces = len(mesh.polygons)
+    centers = np.empty(num_faces * 3, dtype=np.float32)
+    mesh.polygons.foreach_get("center", centers)
+    centers = centers.reshape((num_faces, 3))
+
+    if face_mask is not None:
+        centers = centers[face_mask]
+
+    if len(centers) == 0:
+        return np.zeros(3)
+
+    return centers.mean(axis=0, dtype=np.float64)
+
+
+def project_loops(
+    loop_co: np.ndarray,
+    cox: np.ndarray,
+    coy: np.ndarray,
+    loop_mask: np.ndarray,
+    loc: np.ndarray,
+    scale_inv: float,
+    uvs: np.ndarray,
+) -> None:
+    """
+    Projects the masked loops in a range of loops into uvs, given
+    the projection axes of each loop's face. Only in-place ufuncs
+    are used, which release the GIL, so ranges can be projected
+    from several threads at once.
+    """
+    u = np.empty(len(loop_co))
+    v = np.empty(len(loop_co))
+
+    use_y = cox == 1
+    np.subtract(loop_co[:, 1], loc[1], out=u, where=use_y)
+    np.subtract(loop_co[:, 0], loc[0], out=u, where=~use_y)
+
+    use_z = coy == 2
+    np.subtract(loop_co[:, 2], loc[2], out=v, where=use_z)
+    np.subtract(loop_co[:, 1], loc[1], out=v, where=~use_z)
+
+    # Project coordinate to 0-1 UV space
+    # 0.5 centers the projection on the UV tile
+    for out, axis in ((u, 0), (v, 1)):
+        np.multiply(out, scale_inv, out=out)
+        np.add(out, 0.5, out=out)
+        np.copyto(uvs[:, axis], out, casting="same_kind", where=loop_mask)
+
+
+# Meshes with fewer loops than this aren't worth
+# spinning up threads for
+THREADING_MIN_LOOPS = 1_000_000
+
+
+def project_loops_threaded(
+    loop_co: np.ndarray,
+    cox: np.ndarray,
+    coy: np.ndarray,
+    loop_mask: np.ndarray,
+    loc: np.ndarray,
+    scale_inv: float,
+    uvs: np.ndarray,
+    pool: ThreadPoolExecutor | None = None,
+    threads: int = 1,
+) -> None:
+    """
+    Splits the loops into one contiguous range per thread and
+    projects them with project_loops on the pool. Gives bit-identical
+    results to a single project_loops call. Without a pool, the loops
+    are projected on the calling thread.
+    """
+    num_loops = len(loop_co)
+    threads = max(1, min(threads, num_loops))
+
+    if pool is None or threads == 1:
+        project_loops(loop_co, cox, coy, loop_mask, loc, scale_inv, uvs)
+        return
+
+    bounds = np.linspace(0, num_loops, threads + 1, dtype=np.int64)
+    futures = [
+        pool.submit(
+            project_loops,
+            loop_co[start:end],
+            cox[start:end],
+            coy[start:end],
+            loop_mask[start:end],
+            loc,
+            scale_inv,
+            uvs[start:end],
+        )
+        for start, end in zip(bounds[:-1], bounds[1:])
+    ]
+    for future in futures:
+        future.result()
+
+
+def resolve_threads(num_loops: int, threads: int | None = None) -> int:
+    """
+    How many threads to project a mesh with. If threads is None,
+    it's picked based on the number of loops in the whole mesh.
+    """
+    if threads is not None:
+        return max(1, threads)
+    if num_loops >= THREADING_MIN_LOOPS:
+        return os.cpu_count() or 1
+    return 1
+
+
+def cube_project_mesh_steps(
+    mesh: bpy.types.Mesh,
+    cube_size: float = 1.0,
+    use_select: bool | None = True,
+    center: mathutils.Vector | None = None,
+    chunk_size: int | None = None,
+    threads: int | None = None,
+    profile: UnwrapProfile | None = None,
+) -> Generator[int, None, None]:
+    """
+    Generator version of cube_project_mesh that projects chunk_size
+    faces at a time, yielding how many faces are done after each
+    chunk. UVs are only written to the mesh once every chunk is done,
+    so stopping early leaves the mesh untouched.
+
+    If use_select is None, only the selected faces are projected
+    if there are any, and every face otherwise.
+    """
+    num_faces = len(mesh.polygons)
+    num_loops = len(mesh.loops)
+    if num_faces == 0:
+        return
+
+    with profile_phase(profile, mesh, "read"):
+        normals = np.empty(num_faces * 3, dtype=np.float32)
+        mesh.polygons.foreach_get("normal", normals)
+        normals = normals.reshape((num_faces, 3))
+
+        loop_starts = np.empty(num_faces, dtype=np.int32)
+        loop_totals = np.empty(num_faces, dtype=np.int32)
+        mesh.polygons.foreach_get("loop_start", loop_starts)
+        mesh.polygons.foreach_get("loop_total", loop_totals)
+
+        vert_indices = np.empty(num_loops, dtype=np.int32)
+        mesh.loops.foreach_get("vertex_index", vert_indices)
+
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", co)
+        loop_co = co.reshape((-1, 3))[vert_indices].astype(np.float64)
+
+        face_mask = read_face_selection(mesh)
+        if use_select is None:
+            use_select = bool(face_mask.any())
+        if not use_select:
+            face_mask[:] = True
+
+    with profile_phase(profile, mesh, "center"):
+        if center is None:
+            loc = calculate_selection_center_mesh(mesh, face_mask)
+        else:
+            loc = np.array(center, dtype=np.float64)
+
+    # Prevent division by zero
+    if cube_size == 0.0:
+        cube_size = 1.0
+
+    scale_inv = 1.0 / cube_size
+
+    with profile_phase(profile, mesh, "axes"):
+        # Faces are stored contiguously, so the owning face
+        # of every loop is just the face index repeated
+        loop_face = np.repeat(np.arange(num_faces), loop_totals)
+        loop_mask = face_mask[loop_face]
+
+        # Determine which plane to map each face onto
+        cox, coy = get_dominant_axis_indices_array(normals)
+        loop_cox = cox[loop_face]
+        loop_coy = coy[loop_face]
+
+    with profile_phase(profile, mesh, "read"):
+        # Unselected faces keep their UVs, so read them back
+        # first unless every face is being projected
+        uv_layer = mesh.uv_layers.active
+        uvs = np.zeros(num_loops * 2, dtype=np.float32)
+        if uv_layer is not None and not loop_mask.all():
+            uv_layer.data.foreach_get("uv", uvs)
+        uvs = uvs.reshape((num_loops, 2))
+
+    if chunk_size is None:
+        chunk_size = num_faces
+
+    # Decided once for the whole mesh, so splitting it into chunks
+    # doesn't turn threading off, and every chunk shares one pool
+    threads = resolve_threads(num_loops, threads)
+    pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+
+    with pool or nullcontext():
+        for face_start in range(0, num_faces, chunk_size):
+            face_end = min(face_start + chunk_size, num_faces)
+            chunk = slice(
+                loop_starts[face_start],
+                loop_starts[face_end - 1] + loop_totals[face_end - 1],
+            )
+            with profile_phase(profile, mesh, "project"):
+                project_loops_threaded(
+                    loop_co[chunk],
+                    loop_cox[chunk],
+                    loop_coy[chunk],
+                    loop_mask[chunk],
+                    loc,
+                    scale_inv,
+                    uvs[chunk],
+                    pool,
+                    threads,
+                )
+            yield face_end
+
+    with profile_phase(profile, mesh, "write"):
+        if uv_layer is None:
+            uv_layer = mesh.uv_layers.new(do_init=False)
+
+        uv_layer.data.foreach_set("uv", uvs.ravel())
+        mesh.update()
+
+
+def cube_project_mesh(
+    mesh: bpy.types.Mesh,
+    cube_size: float = 1.0,
+    use_select: bool = True,
+    center: mathutils.Vector | None = None,
+    threads: int | None = None,
+) -> None:
+    """
+    NumPy equivalent of cube_project, operating on Mesh data
+    directly. Gives the same UVs as cube_project (up to float
+    rounding) without a BMesh round trip. Large meshes are
+    projected on several threads, see project_loops_threaded.
+    """
+    exhaust(
+        cube_project_mesh_steps(
+            mesh, cube_size, use_select, center, threads=threads
+        )
+    )
+
+
+ENGINES = (
+    ("NUMPY", "NumPy", "Project in bulk on the mesh data with NumPy"),
+    ("BMESH", "BMesh", "Project face by face through BMesh"),
+)
+
+
+# Custom property on the mesh holding the fingerprint of
+# the geometry it was last unwrapped with
+FINGERPRINT_KEY = "unwrap_selected_fingerprint"
+
+
+def mesh_fingerprint(
+    mesh: bpy.types.Mesh,
+    cube_size: float = 1.0,
+    center: mathutils.Vector | None = None,
+    use_select: bool | None = None,
+) -> str:
+    """
+    Computes a compact hash of everything that affects the result
+    of unwrapping the mesh: vertex positions, loop topology, face
+    selection (unless every face gets projected regardless) and the
+    projection settings.
+    """
+    num_faces = len(mesh.polygons)
+
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+
+    loop_totals = np.empty(num_faces, dtype=np.int32)
+    mesh.polygons.foreach_get("loop_total", loop_totals)
+
+    vert_indices = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", vert_indices)
+
+    select = np.empty(num_faces, dtype=bool)
+    mesh.polygons.foreach_get("select", select)
+
+    settings = (
+        len(co),
+        len(loop_totals),
+        len(vert_indices),
+        cube_size,
+        tuple(center) if center is not None else None,
+        use_select,
+    )
+
+    fingerprint = hashlib.blake2b(repr(settings).encode(), digest_size=16)
+    fingerprint.update(co)
+    fingerprint.update(loop_totals)
+    fingerprint.update(vert_indices)
+    if use_select is not False:
+        fingerprint.update(select)
+    return fingerprint.hexdigest()
+
+
+def unwrap_mesh_steps(
+    mesh: bpy.types.Mesh,
+    engine: str = "NUMPY",
+    cube_size: float = 1.0,
+    force: bool = False,
+    chunk_size: int | None = None,
+    threads: int | None = None,
+    profile: UnwrapProfile | None = None,
+    center: mathutils.Vector | None = None,
+    use_select: bool | None = None,
+) -> Generator[int, None, bool]:
+    """
+    Generator version of unwrap_mesh, yielding how many faces are
+    done as it goes (only the NumPy engine works in chunks). Returns
+    whether the mesh was unwrapped.
+    """
+    with profile_phase(profile, mesh, "fingerprint"):
+        fingerprint = mesh_fingerprint(mesh, cube_size, center, use_select)
+        if (
+            not force
+            and mesh.uv_layers.active is not None
+            and mesh.get(FINGERPRINT_KEY) == fingerprint
+        ):
+            return False
+
+    if engine == "NUMPY":
+        yield from cube_project_mesh_steps(
+            mesh,
+            cube_size,
+            use_select,
+            center=center,
+            chunk_size=chunk_size,
+            threads=threads,
+            profile=profile,
+        )
+    else:
+        with profile_phase(profile, mesh, "from_mesh"):
+            bm = bmesh.new()
+            bm.from_mesh(mesh)
+
+        with profile_phase(profile, mesh, "selection"):
+            select = read_face_selection(mesh)
+            if use_select is None:
+                has_selection = bool(select.any())
+            else:
+                has_selection = use_select
+
+        if center is None:
+            with profile_phase(profile, mesh, "center"):
+                center = calculate_selection_center_mesh(
+                    mesh, select if has_selection else None
+                )
+
+        with profile_phase(profile, mesh, "project"):
+            cube_project(bm, cube_size, has_selection, center=center)
+
+        with profile_phase(profile, mesh, "to_mesh"):
+            bm.to_mesh(mesh)
+            bm.free()
+            mesh.update()
+
+    mesh[FINGERPRINT_KEY] = fingerprint
+    return True
+
+
+def unwrap_mesh(
+    mesh: bpy.types.Mesh,
+    engine: str = "NUMPY",
+    cube_size: float = 1.0,
+    force: bool = False,
+    threads: int | None = None,
+    profile: UnwrapProfile | None = None,
+    center: mathutils.Vector | None = None,
+    use_select: bool | None = None,
+) -> bool:
+    """
+    Cube projects the given mesh with the given engine. Meshes that
+    haven't changed since they were last unwrapped are skipped unless
+    force is set. Returns whether the mesh was unwrapped.
+
+    The projection is centered on center (in the mesh's object space)
+    if given, otherwise on the center of the projected faces. With
+    use_select None, only the selected faces are projected if there
+    are any, otherwise it says whether to stick to the selection.
+    """
+    return exhaust(
+        unwrap_mesh_steps(
+            mesh,
+            engine,
+            cube_size,
+            force,
+            threads=threads,
+            profile=profile,
+            center=center,
+            use_select=use_select,
+        )
+    )
+
+
+def plan_unwrap(
+    objects: list[bpy.types.Object],
+) -> tuple[dict[bpy.types.Mesh, mathutils.Matrix], int]:
+    """
+    Gathers the unique meshes behind the given objects so each one is
+    only unwrapped once, no matter how many linked duplicates or
+    instances refer to it. Instance collections are walked directly
+    (including nested ones), so no scenes, selection or operators are
+    touched.
+
+    Returns the world matrix of the first object found using each
+    mesh, and how many datablocks were skipped as duplicates.
+    """
+    meshes = {}
+    visited = set()
+    skipped = 0
+
+    pending = deque((obj, mathutils.Matrix.Identity(4)) for obj in objects)
+    while pending:
+        obj, instance_matrix = pending.popleft()
+        matrix = instance_matrix @ obj.matrix_world
+
+        # Get the "instance collection"
+        coll = obj.instance_collection
+
+        if coll:
+            # Collections can end up instancing themselves, so keep
+            # track of which ones we've already walked
+            if coll in visited:
+                skipped += 1
+                continue
+
+            visited.add(coll)
+            coll_matrix = matrix @ mathutils.Matrix.Translation(-coll.instance_offset)
+            pending.extend((child, coll_matrix) for child in coll.all_objects)
+            continue
+
+        if obj.type != "MESH":
+            continue
+
+        if obj.data in meshes:
+            skipped += 1
+            continue
+
+        meshes[obj.data] = matrix
+
+    return meshes, skipped
+
+
+CENTER_SPACES = (
+    ("SELECTION", "Selection", "Center on the selected faces of each mesh"),
+    ("OBJECT", "Object", "Center on a fixed point in each mesh's object space"),
+    ("WORLD", "World", "Center on a fixed point in world space"),
+    ("CURSOR", "3D Cursor", "Center on the 3D cursor"),
+)
+
+
+def resolve_center(
+    center_space: str,
+    matrix: mathutils.Matrix,
+    center: mathutils.Vector | None = None,
+) -> mathutils.Vector | None:
+    """
+    Returns the projection center in the object space of a mesh with
+    the given world matrix, or None to use the selection center. The
+    given center is in object space for "OBJECT" and in world space
+    for "WORLD". Sharing a world space center means it only needs
+    computing once, rather than once per mesh.
+    """
+    if center_space == "SELECTION":
+        return None
+
+    if center_space == "OBJECT":
+        return mathutils.Vector(center)
+
+    if center_space == "CURSOR":
+        center = bpy.context.scene.cursor.location
+
+    return matrix.inverted_safe() @ mathutils.Vector(center)
+
+
+# Events the modal unwrap lets through while it runs, so the view
+# can still be navigated. Everything else is swallowed, since undo
+# or deleting objects would pull the meshes out from under it
+NAVIGATION_EVENTS = {
+    "MOUSEMOVE",
+    "INBETWEEN_MOUSEMOVE",
+    "MIDDLEMOUSE",
+    "WHEELUPMOUSE",
+    "WHEELDOWNMOUSE",
+    "TRACKPADPAN",
+    "TRACKPADZOOM",
+    "MOUSEROTATE",
+    "MOUSESMARTZOOM",
+    "NDOF_MOTION",
+}
+
+
 class UNWRAP_OT_unwrap_selected(bpy.types.Operator):
     bl_idname = "object.unwrap_selected"
     bl_label = "Unwrap Selected Objects"
 
-    def execute(self, context: bpy.types.Context):
-        selected = (obj for obj in bpy.context.selected_objects)
+    engine: bpy.props.EnumProperty(
+        name="Engine",
+        description="Which cube projection implementation to use",
+        items=ENGINES,
+        default="NUMPY",
+    )
 
-        for obj in selected:
-            # Get the "instance collection"
-            coll = obj.instance_collection
+    force: bpy.props.BoolProperty(
+        name="Force",
+        description="Unwrap meshes even if they haven't changed since the last unwrap",
+        default=False,
+    )
 
-            if not coll:
-                if obj.type != "MESH":
-                    continue
+    time_budget: bpy.props.FloatProperty(
+        name="Time Budget",
+        description="Milliseconds of unwrapping to do between UI updates",
+        default=50.0,
+        min=1.0,
+    )
 
-                bm = bmesh.new()
-                bm.from_mesh(obj.data)
-                has_selection = any(f.select for f in bm.faces)
+    chunk_size: bpy.props.IntProperty(
+        name="Chunk Size",
+        description="How many faces of a mesh to project at a time",
+        default=100000,
+        min=1,
+    )
 
-                cube_project(bm, 1.0, has_selection, center=None)
+    threads: bpy.props.IntProperty(
+        name="Threads",
+        description=(
+            "How many threads to project large meshes with, "
+            "0 picks automatically based on mesh size"
+        ),
+        default=0,
+        min=0,
+    )
 
-                bm.to_mesh(obj.data)
-                bm.free()
-                obj.data.update()
+    center_space: bpy.props.EnumProperty(
+        name="Center",
+        description="What to center the projection on",
+        items=CENTER_SPACES,
+        default="SELECTION",
+    )
 
-                continue
+    center: bpy.props.FloatVectorProperty(
+        name="Center Point",
+        description=(
+            "Point to center the projection on, in object space for Object "
+            "and in world space for World"
+        ),
+        default=(0.0, 0.0, 0.0),
+        subtype="XYZ",
+    )
+
+    profile: bpy.props.BoolProperty(
+        name="Profile",
+        description="Time every phase of the unwrap and report the slowest meshes",
+        default=False,
+    )
+
+    profile_top: bpy.props.IntProperty(
+        name="Profile Top",
+        description="How many of the slowest meshes to report",
+        default=5,
+        min=1,
+    )
+
+    profile_path: bpy.props.StringProperty(
+        name="Profile Path",
+        description="Optional .json or .csv file to write the profile to",
+        default="",
+        subtype="FILE_PATH",
+    )
+
+    # When run from the UI this works as a modal operator,
+    # unwrapping a bit of the selection on every timer tick
+    # so Blender stays responsive and can show progress.
+    # Calling it from a script (or in background mode) runs
+    # execute instead, which does everything in one go.
+    def invoke(self, context: bpy.types.Context, event: bpy.types.Event):
+        if context.window is None:
+            return self.execute(context)
+
+        self._meshes = self.plan(context)
+        self._index = 0
+        self._steps = None
+
+        self._total_faces = sum(len(mesh.polygons) for mesh, _ in self._meshes)
+        self._faces_done = 0
+
+        wm = context.window_manager
+        wm.progress_begin(0, max(self._total_faces, 1))
+        self._timer = wm.event_timer_add(0.01, window=context.window)
+        wm.modal_handler_add(self)
+        return {"RUNNING_MODAL"}
+
+    def modal(self, context: bpy.types.Context, event: bpy.types.Event):
+        if event.type == "ESC":
+            # Meshes that were already unwrapped stay unwrapped,
+            # while the one in progress is left untouched
+            if self._steps is not None:
+                self._steps.close()
+            self.finish(context)
+            self.report(
+                {"WARNING"},
+                f"Cancelled, unwrapped {self._index - self._unchanged} "
+                f"of {len(self._meshes)} meshes",
+            )
+            return {"CANCELLED"}
+
+        if event.type in NAVIGATION_EVENTS:
+            return {"PASS_THROUGH"}
+        if event.type != "TIMER":
+            return {"RUNNING_MODAL"}
 
-            # Copied from here:
-            # https://github.com/SuperFLEB/BlenderEditCollectionAddon/blob/7468e21cf887cb89b92eb0b46a75165ca51b750e/src/__init__.py#L37C9-L42C49
-            #
-            # In essence, what we're doing here is we're
-            # creating a new Blender scene that contains
-            # just the source collection for the object
-            #
-            # From there, we can then perform the rest
-            # of our tasks
-            scene_name = f"temp:{coll.name}"
-            bpy.ops.scene.new(type="EMPTY")
-            new_scene = bpy.context.scene
-            new_scene.name = scene_name
-            bpy.context.window.scene = new_scene
-            new_scene.collection.children.link(coll)
-            bpy.context.view_layer.active_layer_collection = (
-                bpy.context.view_layer.layer_collection.children[coll.name]
+        try:
+            return self.step(context)
+        except Exception as e:
+            # Anything but finishing normally still has to take
+            # down the timer, progress bar and status text
+            if self._steps is not None:
+                self._steps.close()
+            self.finish(context)
+            self.report(
+                {"ERROR"},
+                f"Unwrapping failed after {self._index - self._unchanged} "
+                f"of {len(self._meshes)} meshes: {e}",
             )
+            return {"CANCELLED"}
 
-            bpy.ops.object.select_all(action="DESELECT")
-            self.unwrap_instance_collection()
+    def step(self, context: bpy.types.Context):
+        """Unwraps as much as fits in the time budget"""
+        mesh_faces_done = 0
+        deadline = time.perf_counter() + self.time_budget / 1000.0
+        while time.perf_counter() < deadline:
+            if self._index >= len(self._meshes):
+                self.finish(context)
+                self.report_done(len(self._meshes))
+                return {"FINISHED"}
 
-            # Delete the new scene created for modifying
-            # instance collection
-            bpy.ops.scene.delete()
+            mesh, center = self._meshes[self._index]
+            if self._steps is None:
+                self._steps = unwrap_mesh_steps(
+                    mesh,
+                    self.engine,
+                    force=self.force,
+                    chunk_size=self.chunk_size,
+                    threads=self.threads or None,
+                    profile=self._profile,
+                    center=center,
+                )
 
+            try:
+                mesh_faces_done = next(self._steps)
+            except StopIteration as done:
+                if not done.value:
+                    self._unchanged += 1
+                self._faces_done += len(mesh.polygons)
+                self._index += 1
+                self._steps = None
+                mesh_faces_done = 0
+
+        faces_done = self._faces_done + mesh_faces_done
+        context.window_manager.progress_update(faces_done)
+        context.workspace.status_text_set(
+            f"Unwrapping mesh {self._index + 1}/{len(self._meshes)}, "
+            f"{faces_done}/{self._total_faces} faces (Esc to cancel)"
+        )
+        return {"RUNNING_MODAL"}
+
+    def finish(self, context: bpy.types.Context) -> None:
+        if self._timer is None:
+            return
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        self._timer = None
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+
+    def execute(self, context: bpy.types.Context):
+        meshes = self.plan(context)
+
+        for mesh, center in meshes:
+            if not unwrap_mesh(
+                mesh,
+                self.engine,
+                force=self.force,
+                threads=self.threads or None,
+                profile=self._profile,
+                center=center,
+            ):
+                self._unchanged += 1
+
+        self.report_done(len(meshes))
         return {"FINISHED"}
 
-    def unwrap_instance_collection(self) -> None:
-        bpy.ops.object.select_all(action="SELECT")
-        selected_instance = (obj for obj in bpy.context.selected_objects)
-        bpy.ops.object.select_all(action="DESELECT")
+    def plan(
+        self, context: bpy.types.Context
+    ) -> list[tuple[bpy.types.Mesh, mathutils.Vector | None]]:
+        """Returns every mesh to unwrap along with its projection center"""
+        self._profile = UnwrapProfile() if self.profile else None
+        self._unchanged = 0
 
-        for obj in selected_instance:
-            if obj.type != "MESH":
-                continue
+        start = time.perf_counter()
+        meshes, self._skipped = plan_unwrap(context.selected_objects)
+        meshes = [
+            (mesh, resolve_center(self.center_space, matrix, self.center))
+            for mesh, matrix in meshes.items()
+        ]
+        if self._profile is not None:
+            self._profile.plan_time = time.perf_counter() - start
 
-            bm = bmesh.new()
-            bm.from_mesh(obj.data)
-            has_selection = any(f.select for f in bm.faces)
+        return meshes
 
-            cube_project(bm, 1.0, has_selection, center=None)
+    def report_done(self, num_meshes: int) -> None:
+        self.report(
+            {"INFO"},
+            f"Unwrapped {num_meshes - self._unchanged} meshes, "
+            f"skipped {self._unchanged} unchanged meshes and "
+            f"{self._skipped} duplicate datablocks",
+        )
 
-            bm.to_mesh(obj.data)
-            bm.free()
-            obj.data.update()
+        if self._profile is None:
+            return
+
+        for line in self._profile.summary(self.profile_top):
+            self.report({"INFO"}, line)
+
+        if self.profile_path:
+            path = bpy.path.abspath(self.profile_path)
+            self._profile.write(path)
+            self.report({"INFO"}, f"Wrote profile to {path}")
 
 
 class UNWRAP_PT_unwrap_selected(bpy.types.Panel):